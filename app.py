@@ -1,16 +1,30 @@
 import sqlite3
-from flask import Flask, render_template, request, redirect, url_for, flash, g, session, make_response
-from datetime import datetime, timedelta, time as dt_time
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, g, session, make_response, abort, Response
+from flask import before_render_template, template_rendered
+from datetime import datetime
 import jdatetime
 import pytz
 import uuid
 import requests # Added for payment gateway
+from requests.adapters import HTTPAdapter
 import json     # Added for payment gateway
+import threading
+import atexit
+import time
+import os
+import queue
+import cProfile
+import gzip
+import re
+from bisect import bisect_right
+from functools import lru_cache
+from scheduler import ResourceCalendar, OccupancyMap, MINUTES_PER_DAY, to_slot_start, slot_start_datetime, day_from_date
 
 app = Flask(__name__)
 # IMPORTANT: Change this secret key for production!
 app.secret_key = 'your_very_secret_key_for_flash_messages_and_session_!@#$_MUST_CHANGE_VERY_MUCH_AGAIN'
-DATABASE = 'appointments.db'
+DATABASE = os.environ.get('DATABASE', 'appointments.db')
 DEVICE_ID_COOKIE_NAME = 'app_device_id_v1'
 
 # --- Timezone and Calendar Constants ---
@@ -19,28 +33,239 @@ SHAMSI_FORMAT_FULL = "%A، %d %B %Y، ساعت %H:%M"
 SHAMSI_FORMAT_DATETIME_ONLY = "%d %B %Y، ساعت %H:%M"
 SHAMSI_DISPLAY_FORMAT_CURRENT_TIME_BASE = "%A، %d %B %Y، ساعت "
 SHAMSI_DISPLAY_FORMAT_CURRENT_TIME = f"{SHAMSI_DISPLAY_FORMAT_CURRENT_TIME_BASE}<span id='live-time'>%H:%M:%S</span>"
-APPOINTMENT_DURATION_MINUTES = 45
+APPOINTMENT_DURATION_MINUTES = 45 # Slot length of the default resource; per-resource hours live in the resources table
+DAYS_TO_SHOW = 7
+SHAMSI_STR_CACHE_SIZE = 4096
+
+# --- Resource Constants ---
+DEFAULT_RESOURCE_ID = 1
+RESOURCE_CALENDAR_TTL_SECONDS = 60 # How often edits to the resources table are picked up
+
+# --- SQLite Tuning Constants (applied to every pooled connection in _configure_connection) ---
+SQLITE_POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8)) # 0 disables pooling
+SQLITE_JOURNAL_MODE = os.environ.get('SQLITE_JOURNAL_MODE', 'WAL')
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL') # NORMAL is durable enough under WAL
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 64 * 1024 * 1024))
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+SQLITE_CACHED_STATEMENTS = int(os.environ.get('SQLITE_CACHED_STATEMENTS', 256))
+
+# --- Instrumentation Constants ---
+METRICS_ENABLED = os.environ.get('METRICS_ENABLED', '0') == '1' # Exposes /metrics in Prometheus text format
+PROFILE_DIR = os.environ.get('PROFILE_DIR') # When set, requests carrying PROFILE_HEADER dump a cProfile file here
+PROFILE_HEADER = 'X-Profile'
+METRICS_BUCKETS_SECONDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# --- Availability Cache Constants ---
+AVAILABILITY_CACHE_TTL_SECONDS = 5
+# Optional SQLite file shared by all gunicorn workers to publish availability version bumps
+AVAILABILITY_SHARED_STORE = os.environ.get('AVAILABILITY_SHARED_STORE')
+
+# --- Slot Hold Constants ---
+SLOT_HOLD_TTL_SECONDS = 15 * 60 # Covers the round-trip through the payment gateway
+SLOT_HOLD_SWEEP_INTERVAL_SECONDS = 60
+
+# --- Availability Event Stream Constants ---
+# Each open stream holds a thread under app.run and a whole worker under gunicorn's sync workers, so the
+# booking page only subscribes where idle streams are cheap: asgi.py turns this on, or set it for gevent workers
+LIVE_AVAILABILITY_ENABLED = os.environ.get('LIVE_AVAILABILITY_ENABLED', '0') == '1'
+SSE_MAX_SUBSCRIBERS = 5000
+SSE_CLIENT_QUEUE_SIZE = 32 # Events buffered per client before it is considered slow and dropped
+SSE_HEARTBEAT_SECONDS = 15
+SSE_RETRY_MS = 3000
+
+# --- Payment Outbox Constants ---
+PAYMENT_WORKER_IN_PROCESS = os.environ.get('PAYMENT_WORKER_IN_PROCESS', '1') == '1' # Set to 0 when running `flask payment-worker` separately
+PAYMENT_WORKER_POLL_SECONDS = 5
+PAYMENT_VERIFY_LEASE_SECONDS = 60 # A crashed worker's claim becomes due again after this
+PAYMENT_VERIFY_MAX_ATTEMPTS = 8
+PAYMENT_VERIFY_RETRY_BASE_SECONDS = 15 # Doubles per attempt
+PAYMENT_STATUS_REFRESH_SECONDS = 2
+
+# --- Appointment Archive Constants ---
+ARCHIVE_HORIZON_DAYS = int(os.environ.get('ARCHIVE_HORIZON_DAYS', 30)) # Appointments that started longer ago leave the hot table
+ARCHIVE_DATABASE = os.environ.get('ARCHIVE_DATABASE') # Optional separate SQLite file for the archive, attached as "archive"
+ARCHIVE_TABLE = 'archive.appointments_archive' if ARCHIVE_DATABASE else 'appointments_archive'
+ARCHIVE_BATCH_SIZE = 500
+ARCHIVE_BATCH_PAUSE_SECONDS = 0.05 # Lets queued bookings in between batches
+ARCHIVE_INTERVAL_SECONDS = 60 * 60
+ARCHIVER_IN_PROCESS = os.environ.get('ARCHIVER_IN_PROCESS', '1') == '1' # Set to 0 when running `flask archive-appointments` from cron
+HISTORY_PAGE_SIZE = 20
+
+# --- Device Activity Buffer Constants ---
+DEVICE_ACTIVITY_FLUSH_SECONDS = 5
+DEVICE_ACTIVITY_FLUSH_SIZE = 500 # Pending devices that trigger an early flush
+DEVICE_ACTIVITY_WRITE_THROUGH = os.environ.get('DEVICE_ACTIVITY_WRITE_THROUGH', '0') == '1' # Write on the request path instead of buffering
 
 # --- Payment Gateway Constants ---
 # IMPORTANT: Replace with your actual Aqa-ye Pardakht PIN
 AQAYEPARDARAKHT_PIN = 'YOUR_GATEWAY_PIN' # !!! REPLACE THIS !!!
-AQAYEPARDARAKHT_CREATE_URL = 'https://panel.aqayepardakht.ir/api/v2/create'
-AQAYEPARDARAKHT_VERIFY_URL = 'https://panel.aqayepardakht.ir/api/v2/verify'
-AQAYEPARDARAKHT_STARTPAY_URL = 'https://panel.aqayepardakht.ir/startpay/'
-APPOINTMENT_PRICE = 25000  # Price per APPOINTMENT_DURATION_MINUTES slot in Toman
+AQAYEPARDARAKHT_BASE_URL = os.environ.get('AQAYEPARDARAKHT_BASE_URL', 'https://panel.aqayepardakht.ir') # Point at a stub gateway for tests
+AQAYEPARDARAKHT_CREATE_URL = f'{AQAYEPARDARAKHT_BASE_URL}/api/v2/create'
+AQAYEPARDARAKHT_VERIFY_URL = f'{AQAYEPARDARAKHT_BASE_URL}/api/v2/verify'
+AQAYEPARDARAKHT_STARTPAY_URL = f'{AQAYEPARDARAKHT_BASE_URL}/startpay/'
+GATEWAY_CONNECT_TIMEOUT_SECONDS = 3.05
+GATEWAY_READ_TIMEOUT_SECONDS = 10
+GATEWAY_POOL_MAXSIZE = 20 # Keep-alive connections kept open to the gateway
+GATEWAY_VERIFY_RETRIES = 2 # Verify is idempotent; create is never retried
+GATEWAY_RETRY_BACKOFF_SECONDS = 0.5
+GATEWAY_BREAKER_FAILURE_THRESHOLD = 5 # Consecutive failures before failing fast
+GATEWAY_BREAKER_RESET_SECONDS = 30
+APPOINTMENT_PRICE = 25000  # Price per APPOINTMENT_DURATION_MINUTES of booked time in Toman; longer slots cost pro rata
+
+# --- Instrumentation ---
+class Histogram:
+    def __init__(self, name, help_text, label_names, buckets=METRICS_BUCKETS_SECONDS):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {} # label values -> [per-bucket counts..., +Inf count, sum]
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [0] * (len(self.buckets) + 2)
+            for i, upper_bound in enumerate(self.buckets):
+                if value <= upper_bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(self.buckets)] += 1
+            series[-1] += value
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} histogram']
+        with self._lock:
+            snapshot = {labels: list(series) for labels, series in self._series.items()}
+        for label_values, series in sorted(snapshot.items()):
+            labels = ','.join(f'{n}="{v}"' for n, v in zip(self.label_names, label_values))
+            cumulative = 0
+            for upper_bound, count in zip(self.buckets + ('+Inf',), series[:-1]):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{{{labels}{"," if labels else ""}le="{upper_bound}"}} {cumulative}')
+            lines.append(f'{self.name}_sum{{{labels}}} {series[-1]}')
+            lines.append(f'{self.name}_count{{{labels}}} {cumulative}')
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text, label_names):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self._lock = threading.Lock()
+        self._values = {} # label values -> count
+
+    def inc(self, *label_values):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help_text}', f'# TYPE {self.name} counter']
+        with self._lock:
+            snapshot = dict(self._values)
+        for label_values, value in sorted(snapshot.items()):
+            labels = ','.join(f'{n}="{v}"' for n, v in zip(self.label_names, label_values))
+            lines.append(f'{self.name}{{{labels}}} {value}')
+        return lines
+
+REQUEST_DURATION = Histogram('booking_request_duration_seconds', 'Time spent handling a request.', ('endpoint', 'method', 'status'))
+SQL_DURATION = Histogram('booking_sql_duration_seconds', 'Time spent in sqlite3 execute calls.', ('statement',))
+GATEWAY_DURATION = Histogram('booking_gateway_duration_seconds', 'Payment gateway call latency.', ('operation', 'outcome'))
+TEMPLATE_DURATION = Histogram('booking_template_render_seconds', 'Jinja template render time.', ('template',))
+SQL_LOCK_ERRORS = Counter('booking_sqlite_lock_errors_total', 'sqlite3 calls that gave up waiting for a lock (busy timeout).', ('statement',))
+
+def _sql_statement_kind(sql):
+    # Label by leading keyword only, to keep series cardinality bounded
+    return sql.lstrip().split(None, 1)[0].upper() if sql.strip() else 'EMPTY'
+
+class InstrumentedConnection(sqlite3.Connection):
+    def execute(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        except sqlite3.OperationalError as e:
+            _count_lock_error(e, sql)
+            raise
+        finally:
+            SQL_DURATION.observe(time.perf_counter() - t0, _sql_statement_kind(sql))
+
+    def executemany(self, sql, *args):
+        t0 = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        except sqlite3.OperationalError as e:
+            _count_lock_error(e, sql)
+            raise
+        finally:
+            SQL_DURATION.observe(time.perf_counter() - t0, _sql_statement_kind(sql))
+
+def _count_lock_error(error, sql):
+    if 'locked' in str(error): # "database is locked" / "database table is locked"
+        SQL_LOCK_ERRORS.inc(_sql_statement_kind(sql))
 
 # --- Database Helper Functions ---
+_db_pools = {} # DATABASE path -> queue of idle connections
+_db_pools_lock = threading.Lock()
+
+def _configure_connection(db):
+    db.row_factory = sqlite3.Row
+    db.execute(f'PRAGMA busy_timeout = {SQLITE_BUSY_TIMEOUT_MS}')
+    if ARCHIVE_DATABASE:
+        db.execute('ATTACH DATABASE ? AS archive', (ARCHIVE_DATABASE,))
+        db.execute(f'PRAGMA archive.synchronous = {SQLITE_SYNCHRONOUS}')
+    db.execute(f'PRAGMA journal_mode = {SQLITE_JOURNAL_MODE}') # Without a schema prefix this covers the archive too
+    db.execute(f'PRAGMA synchronous = {SQLITE_SYNCHRONOUS}')
+    db.execute(f'PRAGMA mmap_size = {SQLITE_MMAP_SIZE}')
+    if ARCHIVE_DATABASE:
+        _ensure_attached_archive_schema(db)
+    return db
+
+def _ensure_attached_archive_schema(db):
+    # schema.sql stays the only definition: the archive table's DDL is copied from main into the attached file
+    archive_ddl = db.execute("SELECT sql FROM main.sqlite_master WHERE tbl_name = 'appointments_archive' AND sql IS NOT NULL ORDER BY type DESC").fetchall()
+    for (sql,) in archive_ddl:
+        db.execute(re.sub(r'^CREATE (TABLE|INDEX) (\w+)', r'CREATE \1 IF NOT EXISTS archive.\2', sql))
+
+def _open_connection():
+    db = sqlite3.connect(DATABASE, timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                         cached_statements=SQLITE_CACHED_STATEMENTS, check_same_thread=False,
+                         factory=InstrumentedConnection if METRICS_ENABLED else sqlite3.Connection)
+    return _configure_connection(db)
+
+def _get_pool():
+    pool = _db_pools.get(DATABASE)
+    if pool is None:
+        with _db_pools_lock:
+            pool = _db_pools.setdefault(DATABASE, queue.LifoQueue(maxsize=max(SQLITE_POOL_SIZE, 1)))
+    return pool
+
 def get_db():
     db = getattr(g, '_database', None)
     if db is None:
-        db = g._database = sqlite3.connect(DATABASE)
-        db.row_factory = sqlite3.Row
+        try:
+            db = _get_pool().get_nowait() if SQLITE_POOL_SIZE > 0 else None
+        except queue.Empty:
+            db = None
+        if db is None:
+            db = _open_connection()
+        g._database = db
     return db
 
 @app.teardown_appcontext
 def close_connection(exception):
-    db = getattr(g, '_database', None)
-    if db is not None:
+    db = g.pop('_database', None)
+    if db is None:
+        return
+    if db.in_transaction:
+        db.rollback() # Never hand an open write transaction to the next request
+    if SQLITE_POOL_SIZE <= 0:
+        db.close()
+        return
+    try:
+        _get_pool().put_nowait(db)
+    except queue.Full:
         db.close()
 
 def init_db():
@@ -55,13 +280,12 @@ def init_db():
 def get_current_tehran_time():
     return datetime.now(TEHRAN_TZ)
 
-def gregorian_to_shamsi_str(gregorian_dt_str, format_str=SHAMSI_FORMAT_FULL):
-    try:
-        gregorian_dt = datetime.strptime(gregorian_dt_str, "%Y-%m-%d %H:%M")
-        shamsi_dt = jdatetime.datetime.fromgregorian(datetime=gregorian_dt)
-        return shamsi_dt.strftime(format_str)
-    except ValueError:
-        return gregorian_dt_str
+def get_current_slot_start(current_tehran_dt_aware):
+    return to_slot_start(current_tehran_dt_aware.replace(tzinfo=None))
+
+@lru_cache(maxsize=SHAMSI_STR_CACHE_SIZE) # Same slots are re-rendered on every confirmation/listing
+def slot_start_to_shamsi_str(slot_start, format_str=SHAMSI_FORMAT_FULL):
+    return jdatetime.datetime.fromgregorian(datetime=slot_start_datetime(slot_start)).strftime(format_str)
 
 def gregorian_dt_to_shamsi_str_obj(gregorian_dt_object, format_str=SHAMSI_FORMAT_FULL):
     if gregorian_dt_object.tzinfo is not None:
@@ -69,149 +293,1063 @@ def gregorian_dt_to_shamsi_str_obj(gregorian_dt_object, format_str=SHAMSI_FORMAT
     shamsi_dt = jdatetime.datetime.fromgregorian(datetime=gregorian_dt_object)
     return shamsi_dt.strftime(format_str)
 
-def get_appointment_status(timeslot_gregorian_str, current_tehran_dt_aware):
+def get_appointment_status(slot_start, current_slot_start, duration_minutes=APPOINTMENT_DURATION_MINUTES):
+    # Plain integer comparisons on minutes; both arguments are slot starts
+    if slot_start + duration_minutes <= current_slot_start:
+        return "passed"
+    elif slot_start <= current_slot_start < slot_start + duration_minutes:
+        return "ongoing"
+    else:
+        return "future"
+
+# --- Resources ---
+_resource_calendars = (None, {}) # (loaded_at monotonic, resource_id -> ResourceCalendar)
+
+def get_resource_calendars():
+    global _resource_calendars
+    loaded_at, calendars = _resource_calendars
+    if loaded_at is None or time.monotonic() - loaded_at > RESOURCE_CALENDAR_TTL_SECONDS:
+        rows = get_db().execute('SELECT * FROM resources WHERE active = 1 ORDER BY id').fetchall()
+        calendars = {row['id']: ResourceCalendar.from_row(row) for row in rows}
+        _resource_calendars = (time.monotonic(), calendars)
+    return calendars
+
+def get_resource_calendar(resource_id):
+    return get_resource_calendars().get(resource_id)
+
+def parse_slot_start(resource_calendar, raw_value):
+    # Slot start from form input if it lies on the resource's grid, else None
     try:
-        slot_start_gregorian_naive = datetime.strptime(timeslot_gregorian_str, "%Y-%m-%d %H:%M")
-        slot_end_gregorian_naive = slot_start_gregorian_naive + timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
-        current_tehran_dt_naive = current_tehran_dt_aware.replace(tzinfo=None)
-
-        if slot_end_gregorian_naive < current_tehran_dt_naive:
-            return "passed"
-        elif slot_start_gregorian_naive <= current_tehran_dt_naive < slot_end_gregorian_naive:
-            return "ongoing"
-        else:
-            return "future"
-    except ValueError:
-        return "unknown"
+        slot_start = int(raw_value)
+    except (TypeError, ValueError):
+        return None
+    return slot_start if resource_calendar.slot_index(slot_start) is not None else None
 
 # --- Core Logic Helper Functions ---
-def get_booked_slots():
+def get_booked_slots(window_start, window_end):
+    # Range scan over the covering idx_appointments_slot for every resource. Slots under an unexpired
+    # payment hold are reported as booked too. Returns (resource_id, slot_start) pairs.
+    db = get_db()
+    rows = db.execute('''
+        SELECT resource_id, slot_start FROM appointments WHERE slot_start >= ? AND slot_start < ?
+        UNION
+        SELECT resource_id, slot_start FROM slot_holds WHERE slot_start >= ? AND slot_start < ? AND expires_at > ?
+    ''', (window_start, window_end, window_start, window_end, int(time.time()))).fetchall()
+    return {(row[0], row[1]) for row in rows}
+
+def get_booked_slots_among(slot_starts, resource_id=DEFAULT_RESOURCE_ID):
+    # Point lookups on idx_appointments_resource_slot for the handful of slots in a single booking
+    if not slot_starts:
+        return set()
+    db = get_db()
+    unique_slot_starts = list(set(slot_starts))
+    placeholders = ','.join('?' * len(unique_slot_starts))
+    rows = db.execute(f'SELECT slot_start FROM appointments WHERE resource_id = ? AND slot_start IN ({placeholders})',
+                      (resource_id, *unique_slot_starts)).fetchall()
+    return {row[0] for row in rows}
+
+def get_slots_held_by_others(slot_starts, invoice_id, resource_id=DEFAULT_RESOURCE_ID):
+    if not slot_starts:
+        return set()
     db = get_db()
-    return {slot['timeslot'] for slot in db.execute('SELECT timeslot FROM appointments').fetchall()}
+    unique_slot_starts = list(set(slot_starts))
+    placeholders = ','.join('?' * len(unique_slot_starts))
+    rows = db.execute(f'SELECT slot_start FROM slot_holds WHERE resource_id = ? AND slot_start IN ({placeholders}) AND invoice_id != ? AND expires_at > ?',
+                      (resource_id, *unique_slot_starts, invoice_id, int(time.time()))).fetchall()
+    return {row[0] for row in rows}
+
+# --- Slot Holds ---
+def claim_slot_holds(slot_starts, phone_number, invoice_id, amount, resource_id=DEFAULT_RESOURCE_ID, previous_invoice_id=None):
+    # Check-and-hold in one IMMEDIATE transaction so two checkouts can never hold the same slot;
+    # the payment outbox row is written in the same commit. previous_invoice_id is the session's own
+    # earlier checkout, whose holds are given up if its payment was never started.
+    # Returns the set of slots that were already taken; nothing is held in that case.
+    db = get_db()
+    now_ts = int(time.time())
+    placeholders = ','.join('?' * len(slot_starts))
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        # Expired holds no longer block anyone, nor do this session's earlier holds while their payment is
+        # still 'created'; a hold whose payment has reached the gateway callback is kept until it expires
+        db.execute(f'''
+            DELETE FROM slot_holds WHERE resource_id = ? AND slot_start IN ({placeholders})
+            AND (expires_at <= ? OR invoice_id IN (SELECT invoice_id FROM payments WHERE invoice_id = ? AND status = 'created'))
+        ''', (resource_id, *slot_starts, now_ts, previous_invoice_id))
+        taken_slots = get_booked_slots_among(slot_starts, resource_id)
+        taken_slots |= {row[0] for row in db.execute(f'SELECT slot_start FROM slot_holds WHERE resource_id = ? AND slot_start IN ({placeholders})',
+                                                     (resource_id, *slot_starts)).fetchall()}
+        if taken_slots:
+            db.rollback()
+            return taken_slots
+        db.executemany('INSERT INTO slot_holds (resource_id, slot_start, invoice_id, phone_number, expires_at) VALUES (?, ?, ?, ?, ?)',
+                       [(resource_id, t, invoice_id, phone_number, now_ts + SLOT_HOLD_TTL_SECONDS) for t in slot_starts])
+        db.execute('INSERT INTO payments (invoice_id, phone_number, resource_id, timeslots, amount, status, created_at) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (invoice_id, phone_number, resource_id, json.dumps(slot_starts), amount, 'created', now_ts))
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    availability_cache.invalidate()
+    availability_hub.publish('taken', resource_id, slot_starts)
+    return set()
+
+def finalize_paid_booking(phone_number, slot_starts, invoice_id, payment_trans_id, resource_id=DEFAULT_RESOURCE_ID,
+                          device_id=None, user_agent=None):
+    # The whole post-payment write is one IMMEDIATE transaction (one fsync): a multi-row insert that
+    # skips taken slots and hold cleanup. The device login goes through device_activity after the commit.
+    # Returns (won_slots, lost_slots) in request order.
+    db = get_db()
+    try:
+        db.execute('BEGIN IMMEDIATE')
+        held_by_others = get_slots_held_by_others(slot_starts, invoice_id, resource_id)
+        candidate_slots = [t for t in dict.fromkeys(slot_starts) if t not in held_by_others]
+        won_slots = set()
+        if candidate_slots:
+            values_sql = ','.join(['(?, ?, ?, ?, ?)'] * len(candidate_slots))
+            params = [p for t in candidate_slots for p in (resource_id, t, phone_number, invoice_id, payment_trans_id)]
+            rows = db.execute(f'''
+                INSERT INTO appointments (resource_id, slot_start, phone_number, invoice_id, payment_trans_id) VALUES {values_sql}
+                ON CONFLICT(resource_id, slot_start) DO NOTHING
+                RETURNING slot_start
+            ''', params).fetchall()
+            won_slots = {row[0] for row in rows}
+        db.execute('DELETE FROM slot_holds WHERE invoice_id = ?', (invoice_id,)) # Holds become appointments
+        # Marking the outbox row paid in the same commit makes finalization happen exactly once
+        db.execute("UPDATE payments SET status = 'paid', result = ?, updated_at = ? WHERE invoice_id = ?",
+                   (json.dumps({'won': [t for t in slot_starts if t in won_slots],
+                                'lost': [t for t in slot_starts if t not in won_slots]}),
+                    int(time.time()), invoice_id))
 
-def generate_time_slots():
-    slots = []
-    current_tehran_dt = get_current_tehran_time()
-    today_tehran_date = current_tehran_dt.date()
-    days_to_show = 7
-    slot_duration = timedelta(minutes=APPOINTMENT_DURATION_MINUTES)
-    work_start_time = dt_time(10, 0)
-    work_end_time = dt_time(22, 0)
-    booked_slots = get_booked_slots()
-
-    for day_offset in range(days_to_show):
-        current_gregorian_day_to_process = today_tehran_date + timedelta(days=day_offset)
-        if current_gregorian_day_to_process.weekday() in [3, 4]: # Skip Thursdays (3) and Fridays (4)
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    if won_slots and device_id:
+        device_activity.record_login(phone_number, device_id, user_agent)
+    availability_cache.invalidate()
+    availability_hub.publish('taken', resource_id, [t for t in slot_starts if t in won_slots])
+    return ([t for t in slot_starts if t in won_slots],
+            [t for t in slot_starts if t not in won_slots])
+
+def release_slot_holds(invoice_id):
+    db = get_db()
+    try:
+        released = db.execute('DELETE FROM slot_holds WHERE invoice_id = ? RETURNING resource_id, slot_start', (invoice_id,)).fetchall()
+        db.commit()
+    except Exception as e:
+        db.rollback(); app.logger.error(f"Error releasing slot holds for invoice {invoice_id}: {e}")
+        return
+    if released:
+        availability_cache.invalidate()
+        _publish_freed_slots(released)
+
+def _publish_freed_slots(rows):
+    freed_by_resource = {}
+    for resource_id, slot_start in rows:
+        freed_by_resource.setdefault(resource_id, []).append(slot_start)
+    for resource_id, slot_starts in freed_by_resource.items():
+        availability_hub.publish('freed', resource_id, slot_starts)
+
+def sweep_expired_slot_holds():
+    db = _open_connection()
+    try:
+        with db:
+            now_ts = int(time.time())
+            swept = db.execute('DELETE FROM slot_holds WHERE expires_at <= ? RETURNING resource_id, slot_start', (now_ts,)).fetchall()
+            # Checkouts whose customer never came back from the gateway
+            db.execute("UPDATE payments SET status = 'expired', updated_at = ? WHERE status = 'created' AND created_at <= ?",
+                       (now_ts, now_ts - SLOT_HOLD_TTL_SECONDS))
+    finally:
+        db.close()
+    if swept:
+        availability_cache.invalidate()
+        _publish_freed_slots(swept)
+    return len(swept)
+
+def _slot_hold_sweeper_loop():
+    while True:
+        time.sleep(SLOT_HOLD_SWEEP_INTERVAL_SECONDS)
+        try:
+            sweep_expired_slot_holds()
+        except Exception as e:
+            app.logger.error(f"Slot hold sweep failed: {e}")
+
+# --- Appointment Archive ---
+def archive_past_appointments(horizon_days=ARCHIVE_HORIZON_DAYS, batch_size=ARCHIVE_BATCH_SIZE,
+                              pause_seconds=ARCHIVE_BATCH_PAUSE_SECONDS):
+    # Moves appointments that started more than horizon_days ago into the archive, one short IMMEDIATE
+    # transaction per batch so a booking never waits behind more than one batch. Rows are copied before
+    # they are deleted; a crash in between leaves a duplicate that INSERT OR IGNORE and the UNION in
+    # get_appointment_history absorb. Returns the number of rows moved.
+    cutoff = get_current_slot_start(get_current_tehran_time()) - max(horizon_days, 1) * MINUTES_PER_DAY
+    db = _open_connection()
+    moved = 0
+    try:
+        while True:
+            db.execute('BEGIN IMMEDIATE')
+            try:
+                db.execute(f'''
+                    INSERT OR IGNORE INTO {ARCHIVE_TABLE}
+                        (id, resource_id, slot_start, phone_number, booking_time, invoice_id, payment_trans_id, archived_at)
+                    SELECT id, resource_id, slot_start, phone_number, booking_time, invoice_id, payment_trans_id, ?
+                    FROM appointments WHERE slot_start < ? ORDER BY slot_start LIMIT ?
+                ''', (int(time.time()), cutoff, batch_size))
+                if ARCHIVE_DATABASE: # WAL gives no atomic commit across attached files, so copy and delete commit separately
+                    db.commit()
+                    db.execute('BEGIN IMMEDIATE')
+                batch_moved = db.execute(f'''
+                    DELETE FROM appointments
+                    WHERE id IN (SELECT id FROM appointments WHERE slot_start < ? ORDER BY slot_start LIMIT ?)
+                      AND EXISTS (SELECT 1 FROM {ARCHIVE_TABLE} AS archived WHERE archived.id = appointments.id)
+                ''', (cutoff, batch_size)).rowcount
+                db.commit()
+            except Exception:
+                db.rollback()
+                raise
+            moved += batch_moved
+            if batch_moved < batch_size:
+                break
+            time.sleep(pause_seconds)
+    finally:
+        db.close()
+    return moved
+
+def _archiver_loop():
+    while True:
+        time.sleep(ARCHIVE_INTERVAL_SECONDS)
+        try:
+            moved = archive_past_appointments()
+            if moved:
+                app.logger.info(f"Archived {moved} past appointments")
+        except Exception as e:
+            app.logger.error(f"Appointment archival failed: {e}")
+
+@app.cli.command('archive-appointments')
+@click.option('--horizon-days', default=ARCHIVE_HORIZON_DAYS, show_default=True, help='Archive appointments that started longer ago than this.')
+@click.option('--batch-size', default=ARCHIVE_BATCH_SIZE, show_default=True)
+def archive_appointments_command(horizon_days, batch_size):
+    """Move past appointments from the hot table into the archive."""
+    click.echo(f"Archived {archive_past_appointments(horizon_days, batch_size)} appointments")
+
+def get_upcoming_appointments(phone_number, split_slot_start):
+    # Hot table only: archived rows are always older than the split
+    return get_db().execute('SELECT resource_id, slot_start FROM appointments WHERE phone_number = ? AND slot_start >= ? ORDER BY slot_start ASC',
+                            (phone_number, split_slot_start)).fetchall()
+
+def get_appointment_history(phone_number, before, limit):
+    # One keyset page of past appointments, newest first, across the hot table and the archive.
+    # before is an exclusive (slot_start, resource_id) cursor; each side seeks its covering index and
+    # reads at most limit rows.
+    before_slot_start, before_resource_id = before
+    return get_db().execute(f'''
+        SELECT resource_id, slot_start FROM (
+            SELECT resource_id, slot_start FROM appointments
+            WHERE phone_number = ? AND (slot_start, resource_id) < (?, ?)
+            ORDER BY slot_start DESC, resource_id DESC LIMIT ?
+        )
+        UNION
+        SELECT resource_id, slot_start FROM (
+            SELECT resource_id, slot_start FROM {ARCHIVE_TABLE}
+            WHERE phone_number = ? AND (slot_start, resource_id) < (?, ?)
+            ORDER BY slot_start DESC, resource_id DESC LIMIT ?
+        )
+        ORDER BY slot_start DESC, resource_id DESC LIMIT ?
+    ''', (phone_number, before_slot_start, before_resource_id, limit,
+          phone_number, before_slot_start, before_resource_id, limit, limit)).fetchall()
+
+def parse_history_cursor(raw_cursor):
+    # "<slot_start>.<resource_id>" as emitted in the "older" link; anything else means the first page
+    try:
+        slot_start, resource_id = raw_cursor.split('.')
+        return int(slot_start), int(resource_id)
+    except (AttributeError, ValueError):
+        return None
+
+# --- Device Activity Buffer ---
+class DeviceActivityBuffer:
+    # Logins and auto-logins only record who is on which device and when, so instead of taking SQLite's
+    # write lock on the request path they are kept here and written in one IMMEDIATE transaction per
+    # interval or size threshold, and at exit. Only the newest pending record per device is kept.
+    # Pending logins are visible to this process through pending_phone() and pending_device_info();
+    # other processes see them after the next flush.
+    def __init__(self, flush_size=DEVICE_ACTIVITY_FLUSH_SIZE, write_through=DEVICE_ACTIVITY_WRITE_THROUGH):
+        self.flush_size = flush_size
+        self.write_through = write_through
+        self.flush_requested = threading.Event()
+        self.flushed_records = 0
+        self.flushes = 0
+        self._pending = {} # device_id -> newest record, in the order the records arrived
+        self._phone_devices = {} # phone_number -> device_id of its newest pending login
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock() # One writer at a time keeps records in arrival order
+
+    def record_login(self, phone_number, device_id, user_agent, ip_address=None):
+        # ip_address=None keeps the stored last_login_ip (payment verification has no client address)
+        self._record(device_id, {'phone_number': phone_number, 'user_agent': user_agent, 'ip_address': ip_address,
+                                 'at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())}) # CURRENT_TIMESTAMP's format
+
+    def record_activity(self, device_id, ip_address):
+        self._record(device_id, {'ip_address': ip_address, 'at': time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime())})
+
+    def _record(self, device_id, record):
+        with self._lock:
+            previous = self._pending.pop(device_id, None)
+            if previous and 'phone_number' in previous and 'phone_number' not in record:
+                # Activity after a pending login only moves the login's address and time forward
+                record = dict(previous, ip_address=record['ip_address'] or previous['ip_address'], at=record['at'])
+            elif previous and record['ip_address'] is None:
+                # A login without an address (payment verification) keeps the newest pending one
+                record = dict(record, ip_address=previous['ip_address'])
+            self._pending[device_id] = record
+            if 'phone_number' in record:
+                self._phone_devices[record['phone_number']] = device_id
+            pending_count = len(self._pending)
+        if self.write_through:
+            self.flush(get_db())
+        elif pending_count >= self.flush_size:
+            self.flush_requested.set()
+
+    def pending_phone(self, device_id):
+        record = self._pending.get(device_id)
+        return record.get('phone_number') if record else None
+
+    def pending_device_info(self, phone_number):
+        record = self._pending.get(self._phone_devices.get(phone_number))
+        return record if record and record['phone_number'] == phone_number else None
+
+    def flush(self, db=None):
+        # Returns the number of device records written. A failed flush puts its records back unless
+        # newer ones for the same device arrived meanwhile.
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending, self._phone_devices = self._pending, {}, {}
+            if not pending:
+                return 0
+            own_connection = db is None
+            if own_connection:
+                db = _open_connection()
+            try:
+                db.execute('BEGIN IMMEDIATE')
+                for device_id, record in pending.items():
+                    if 'phone_number' in record:
+                        self._write_login(db, device_id, record)
+                db.executemany('UPDATE user_devices SET last_activity_time = ?, last_login_ip = ? WHERE device_id = ?',
+                               [(r['at'], r['ip_address'], d) for d, r in pending.items() if 'phone_number' not in r])
+                db.commit()
+            except Exception:
+                db.rollback()
+                with self._lock:
+                    for device_id, record in pending.items():
+                        if device_id not in self._pending:
+                            self._pending[device_id] = record
+                            if 'phone_number' in record:
+                                self._phone_devices.setdefault(record['phone_number'], device_id)
+                raise
+            finally:
+                if own_connection:
+                    db.close()
+            self.flushes += 1
+            self.flushed_records += len(pending)
+            return len(pending)
+
+    @staticmethod
+    def _write_login(db, device_id, record):
+        # A device clash must not sink the whole batch, so each login gets its own savepoint
+        params = (record['phone_number'], device_id, record['user_agent'], record['ip_address'], record['at'])
+        db.execute('SAVEPOINT device_login')
+        try:
+            db.execute('''
+                INSERT INTO user_devices (phone_number, device_id, user_agent, last_login_ip, last_activity_time)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(phone_number) DO UPDATE SET
+                    device_id=excluded.device_id, user_agent=excluded.user_agent,
+                    last_login_ip=COALESCE(excluded.last_login_ip, last_login_ip), last_activity_time=excluded.last_activity_time
+            ''', params)
+            db.execute('''
+                INSERT INTO user_devices (phone_number, device_id, user_agent, last_login_ip, last_activity_time)
+                VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(device_id) DO UPDATE SET
+                    phone_number=excluded.phone_number, user_agent=excluded.user_agent,
+                    last_login_ip=COALESCE(excluded.last_login_ip, last_login_ip), last_activity_time=excluded.last_activity_time
+            ''', params)
+            db.execute('RELEASE device_login')
+        except sqlite3.IntegrityError as e:
+            db.execute('ROLLBACK TO device_login'); db.execute('RELEASE device_login')
+            app.logger.error(f"Error updating device info for {record['phone_number']}: {e}")
+
+device_activity = DeviceActivityBuffer()
+
+def _device_activity_flusher_loop():
+    while True:
+        device_activity.flush_requested.wait(DEVICE_ACTIVITY_FLUSH_SECONDS)
+        device_activity.flush_requested.clear()
+        try:
+            device_activity.flush()
+        except Exception as e:
+            app.logger.error(f"Device activity flush failed: {e}")
+
+@atexit.register
+def _flush_device_activity_at_exit():
+    try:
+        flushed = device_activity.flush()
+        if flushed:
+            app.logger.info(f"Flushed {flushed} pending device records at shutdown")
+    except Exception as e:
+        app.logger.error(f"Device activity flush at shutdown failed: {e}")
+
+_background_workers_started = False
+_background_workers_lock = threading.Lock()
+
+@app.before_request
+def start_background_workers():
+    global _background_workers_started
+    if _background_workers_started:
+        return
+    with _background_workers_lock:
+        if not _background_workers_started:
+            threading.Thread(target=_slot_hold_sweeper_loop, name='slot-hold-sweeper', daemon=True).start()
+            threading.Thread(target=_device_activity_flusher_loop, name='device-activity-flusher', daemon=True).start()
+            if PAYMENT_WORKER_IN_PROCESS:
+                threading.Thread(target=run_payment_worker, name='payment-worker', daemon=True).start()
+            if ARCHIVER_IN_PROCESS:
+                threading.Thread(target=_archiver_loop, name='appointment-archiver', daemon=True).start()
+            _background_workers_started = True
+
+# --- Availability Cache ---
+class LocalVersionStore:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version = time.time_ns() // 1000 # Start unique per process so ETags never repeat across restarts
+
+    def get(self):
+        return self._version
+
+    def bump(self):
+        with self._lock:
+            self._version += 1
+            return self._version
+
+class SQLiteVersionStore:
+    # Shared stand-in for Redis & co: one counter row in a small SQLite file all workers can see
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        conn = self._conn()
+        conn.execute('CREATE TABLE IF NOT EXISTS availability_version (id INTEGER PRIMARY KEY CHECK (id = 1), version INTEGER NOT NULL)')
+        conn.execute('INSERT OR IGNORE INTO availability_version (id, version) VALUES (1, 0)')
+        conn.commit()
+
+    def _conn(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = sqlite3.connect(self.path, timeout=5)
+        return conn
+
+    def get(self):
+        return self._conn().execute('SELECT version FROM availability_version WHERE id = 1').fetchone()[0]
+
+    def bump(self):
+        conn = self._conn()
+        with conn:
+            conn.execute('UPDATE availability_version SET version = version + 1 WHERE id = 1')
+        return self.get()
+
+class AvailabilityCache:
+    # Snapshots are tagged with the version read *before* loading from the DB, so a commit that
+    # races with a load always leaves the snapshot stale rather than showing a taken slot as free.
+    def __init__(self, ttl_seconds, version_store):
+        self.ttl_seconds = ttl_seconds
+        self.version_store = version_store
+        self._snapshot = None # (key, version, loaded_at, value)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        version = self.version_store.get()
+        snapshot = self._snapshot
+        if snapshot is not None and snapshot[0] == key and snapshot[1] == version \
+           and time.monotonic() - snapshot[2] < self.ttl_seconds:
+            self.hits += 1
+            return snapshot[3]
+        self.misses += 1
+        value = loader()
+        self._snapshot = (key, version, time.monotonic(), value)
+        return value
+
+    def invalidate(self):
+        self._snapshot = None
+        self.version_store.bump()
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'version': self.version_store.get()}
+
+availability_cache = AvailabilityCache(
+    AVAILABILITY_CACHE_TTL_SECONDS,
+    SQLiteVersionStore(AVAILABILITY_SHARED_STORE) if AVAILABILITY_SHARED_STORE else LocalVersionStore()
+)
+
+def get_availability_window(today_tehran_date):
+    window_start = day_from_date(today_tehran_date) * MINUTES_PER_DAY
+    return window_start, window_start + DAYS_TO_SHOW * MINUTES_PER_DAY
+
+def get_occupancy(today_tehran_date):
+    # Bitmap occupancy of every resource over the bookable window, shared through the availability cache
+    window = get_availability_window(today_tehran_date)
+    return availability_cache.get(window, lambda: OccupancyMap.build(get_resource_calendars(), get_booked_slots(*window)))
+
+# Per-day slot template: slot starts and Shamsi labels depend only on the date and the resource's
+# hours, so they are built once per Tehran day and resource instead of on every GET /.
+_slot_calendar_lock = threading.Lock()
+_slot_calendars = {} # resource_id -> slot template
+
+def _slot_calendar_key(resource_calendar, today_tehran_date):
+    return (today_tehran_date, resource_calendar.slot_minutes, resource_calendar.day_start_minute,
+            resource_calendar.day_end_minute, resource_calendar.closed_weekdays)
+
+def _build_slot_calendar(resource_calendar, today_tehran_date):
+    days = []
+    first_day = day_from_date(today_tehran_date)
+    for day in range(first_day, first_day + DAYS_TO_SHOW):
+        if not resource_calendar.is_open(day):
             continue
+        day_slots = []
+        for slot_index in range(resource_calendar.slots_per_day): # Position in the list == bit in the occupancy bitmap
+            slot_start = resource_calendar.slot_start(day, slot_index)
+            day_slots.append((slot_start, slot_start_to_shamsi_str(slot_start)))
+        days.append((day, tuple(day_slots)))
+
+    return {'key': _slot_calendar_key(resource_calendar, today_tehran_date), 'day': today_tehran_date, 'days': tuple(days),
+            'slot_starts': tuple(slot[0] for _, day_slots in days for slot in day_slots)}
+
+def get_slot_calendar(resource_id, today_tehran_date):
+    resource_calendar = get_resource_calendar(resource_id)
+    if resource_calendar is None:
+        return None
+    key = _slot_calendar_key(resource_calendar, today_tehran_date)
+    calendar = _slot_calendars.get(resource_id)
+    if calendar is None or calendar['key'] != key:
+        with _slot_calendar_lock:
+            calendar = _slot_calendars.get(resource_id)
+            if calendar is None or calendar['key'] != key:
+                calendar = _slot_calendars[resource_id] = _build_slot_calendar(resource_calendar, today_tehran_date)
+    return calendar
+
+def generate_time_slots(resource_id=DEFAULT_RESOURCE_ID, current_tehran_dt=None):
+    current_tehran_dt = current_tehran_dt or get_current_tehran_time()
+    calendar = get_slot_calendar(resource_id, current_tehran_dt.date())
+    if calendar is None:
+        return []
+    occupancy = get_occupancy(current_tehran_dt.date())
+    current_slot_start = get_current_slot_start(current_tehran_dt)
 
-        current_potential_slot_dt_naive = datetime.combine(current_gregorian_day_to_process, work_start_time)
-        day_work_ends_dt_naive = datetime.combine(current_gregorian_day_to_process, work_end_time)
-
-        while current_potential_slot_dt_naive + slot_duration <= day_work_ends_dt_naive:
-            if current_gregorian_day_to_process == today_tehran_date and \
-               current_potential_slot_dt_naive <= current_tehran_dt.replace(tzinfo=None):
-                current_potential_slot_dt_naive += slot_duration
-                continue
-
-            slot_value_gregorian_str = current_potential_slot_dt_naive.strftime("%Y-%m-%d %H:%M")
-            if slot_value_gregorian_str not in booked_slots:
-                slots.append({
-                    "value": slot_value_gregorian_str,
-                    "display": gregorian_dt_to_shamsi_str_obj(current_potential_slot_dt_naive)
-                })
-            current_potential_slot_dt_naive += slot_duration
+    slots = []
+    for day, day_slots in calendar['days']:
+        for slot_index in occupancy.free_slot_indexes(resource_id, day, after=current_slot_start):
+            slot_start, slot_display_shamsi = day_slots[slot_index]
+            slots.append({"value": slot_start, "display": slot_display_shamsi})
     return slots
 
+# --- Availability Event Hub ---
+class AvailabilitySubscriber:
+    def __init__(self, queue_size):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.dropped = False
+        self.notify = None # Set by the ASGI server (asgi.py) to wake its event loop; must be thread-safe
+
+class AvailabilityHub:
+    # In-process fan-out of slot deltas to open /events/availability streams. Publishing never blocks:
+    # a subscriber whose queue is full is dropped and its EventSource reconnects and resyncs.
+    def __init__(self, max_subscribers, queue_size):
+        self.max_subscribers = max_subscribers
+        self.queue_size = queue_size
+        self._lock = threading.Lock()
+        self._subscribers = set()
+
+    def subscribe(self):
+        with self._lock:
+            if len(self._subscribers) >= self.max_subscribers:
+                return None
+            subscriber = AvailabilitySubscriber(self.queue_size)
+            self._subscribers.add(subscriber)
+            return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers.discard(subscriber)
+
+    def publish(self, event_name, resource_id, slot_starts):
+        if not slot_starts or not self._subscribers:
+            return
+        slots = [{'value': t, 'display': slot_start_to_shamsi_str(t)} for t in slot_starts] if event_name == 'freed' \
+            else [{'value': t} for t in slot_starts]
+        payload = {'resource_id': resource_id, 'slots': slots}
+        message = f"event: {event_name}\ndata: {json.dumps(payload, ensure_ascii=False, separators=(',', ':'))}\n\n"
+        with self._lock:
+            subscribers = list(self._subscribers)
+        for subscriber in subscribers:
+            try:
+                subscriber.queue.put_nowait(message)
+            except queue.Full:
+                subscriber.dropped = True
+                self.unsubscribe(subscriber)
+            if subscriber.notify:
+                subscriber.notify()
+
+    def stream(self, subscriber):
+        try:
+            yield f"retry: {SSE_RETRY_MS}\n\n"
+            while not subscriber.dropped:
+                try:
+                    yield subscriber.queue.get(timeout=SSE_HEARTBEAT_SECONDS)
+                except queue.Empty:
+                    yield ": keep-alive\n\n" # Also how we notice clients that went away
+        finally:
+            self.unsubscribe(subscriber)
+
+availability_hub = AvailabilityHub(SSE_MAX_SUBSCRIBERS, SSE_CLIENT_QUEUE_SIZE)
+
+# --- Versioned Availability Responses ---
+# Everything derived from the free-slot list (JSON body, its gzip, the <option> fragment) is built once per
+# availability ETag. The ETag only needs the availability version, the Tehran day and how many of today's
+# slots have already passed, so conditional requests are answered without touching appointments.
+# Without AVAILABILITY_SHARED_STORE other workers' bookings never bump this process's version, so the ETag
+# also carries a TTL epoch and entries are rebuilt at least every AVAILABILITY_CACHE_TTL_SECONDS.
+_versioned_slots = {} # resource_id -> entry
+_versioned_slots_lock = threading.Lock()
+
+def get_availability_etag(resource_id, current_tehran_dt):
+    calendar = get_slot_calendar(resource_id, current_tehran_dt.date())
+    passed_slots = bisect_right(calendar['slot_starts'], get_current_slot_start(current_tehran_dt))
+    version = availability_cache.version_store.get()
+    if not AVAILABILITY_SHARED_STORE:
+        version = f"{version}.{int(time.monotonic() // AVAILABILITY_CACHE_TTL_SECONDS)}"
+    return f"{version}-{resource_id}-{calendar['day'].isoformat()}-{passed_slots}"
+
+def get_versioned_slots(resource_id, etag, current_tehran_dt):
+    entry = _versioned_slots.get(resource_id)
+    if entry is not None and entry['etag'] == etag:
+        return entry
+    with _versioned_slots_lock:
+        entry = _versioned_slots.get(resource_id)
+        if entry is None or entry['etag'] != etag:
+            entry = _versioned_slots[resource_id] = _build_versioned_slots(resource_id, etag, current_tehran_dt)
+    return entry
+
+def _build_versioned_slots(resource_id, etag, current_tehran_dt):
+    slots = generate_time_slots(resource_id, current_tehran_dt)
+    json_body = json.dumps({'version': etag, 'slots': slots}, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    entry = {
+        'etag': etag,
+        'slots': slots,
+        'json': json_body,
+        'json_gzip': gzip.compress(json_body),
+        'options_html': app.jinja_env.get_template('_slot_options.html').render(slots=slots)
+    }
+    return entry
+
+# --- Payment Gateway Client ---
+class GatewayUnavailable(requests.exceptions.RequestException):
+    pass
+
+class CircuitBreaker:
+    # closed -> open after N consecutive failures -> half-open (one trial call) after reset_seconds
+    def __init__(self, failure_threshold, reset_seconds):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self._lock = threading.Lock()
+        self._consecutive_failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+
+    @property
+    def state(self):
+        if self._opened_at is None:
+            return 'closed'
+        return 'half-open' if time.monotonic() - self._opened_at >= self.reset_seconds else 'open'
+
+    def allow(self):
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if time.monotonic() - self._opened_at < self.reset_seconds or self._trial_in_flight:
+                return False
+            self._trial_in_flight = True
+            return True
+
+    def record_success(self):
+        with self._lock:
+            self._consecutive_failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._consecutive_failures += 1
+            self._trial_in_flight = False
+            if self._opened_at is not None or self._consecutive_failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+
+class PaymentGatewayClient:
+    def __init__(self, pool_maxsize, connect_timeout, read_timeout, verify_retries, retry_backoff, breaker):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_maxsize)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.timeout = (connect_timeout, read_timeout)
+        self.verify_retries = verify_retries
+        self.retry_backoff = retry_backoff
+        self.breaker = breaker
+
+    def _post(self, operation, url, data, retries):
+        if not self.breaker.allow():
+            if METRICS_ENABLED:
+                GATEWAY_DURATION.observe(0.0, operation, 'circuit_open')
+            raise GatewayUnavailable(f"Payment gateway circuit is open; not calling {url}")
+        for attempt in range(retries + 1):
+            t0 = time.perf_counter()
+            try:
+                response = self.session.post(url, data=data, timeout=self.timeout)
+                if METRICS_ENABLED:
+                    GATEWAY_DURATION.observe(time.perf_counter() - t0, operation, str(response.status_code))
+                if response.status_code >= 500:
+                    response.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                if METRICS_ENABLED and not isinstance(e, requests.exceptions.HTTPError):
+                    GATEWAY_DURATION.observe(time.perf_counter() - t0, operation, type(e).__name__)
+                transient = isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout, requests.exceptions.HTTPError))
+                if transient and attempt < retries:
+                    time.sleep(self.retry_backoff * (2 ** attempt))
+                    continue
+                self.breaker.record_failure()
+                raise
+            self.breaker.record_success()
+            return response
+
+    def create(self, payment_data):
+        return self._post('create', AQAYEPARDARAKHT_CREATE_URL, payment_data, retries=0)
+
+    def verify(self, verify_data):
+        return self._post('verify', AQAYEPARDARAKHT_VERIFY_URL, verify_data, retries=self.verify_retries)
+
+payment_gateway = PaymentGatewayClient(
+    GATEWAY_POOL_MAXSIZE, GATEWAY_CONNECT_TIMEOUT_SECONDS, GATEWAY_READ_TIMEOUT_SECONDS,
+    GATEWAY_VERIFY_RETRIES, GATEWAY_RETRY_BACKOFF_SECONDS,
+    CircuitBreaker(GATEWAY_BREAKER_FAILURE_THRESHOLD, GATEWAY_BREAKER_RESET_SECONDS)
+)
+
+# --- Payment Outbox and Verification Worker ---
+_payment_worker_wakeup = threading.Event()
+
+def enqueue_payment_verification(invoice_id, trans_id, device_id, user_agent):
+    db = get_db()
+    now_ts = int(time.time())
+    db.execute('''
+        UPDATE payments SET trans_id = ?, device_id = ?, user_agent = ?, status = 'queued',
+            next_attempt_at = ?, updated_at = ?
+        WHERE invoice_id = ? AND status IN ('created', 'expired')
+    ''', (trans_id, device_id, user_agent, now_ts, now_ts, invoice_id))
+    db.commit()
+    _payment_worker_wakeup.set()
+
+def get_payment(invoice_id):
+    return get_db().execute('SELECT * FROM payments WHERE invoice_id = ?', (invoice_id,)).fetchone()
+
+def _claim_due_payment(db):
+    # Claiming pushes next_attempt_at out by a lease, so a crashed worker's job becomes due again
+    now_ts = int(time.time())
+    with db:
+        return db.execute('''
+            UPDATE payments SET status = 'verifying', attempts = attempts + 1, next_attempt_at = ?, updated_at = ?
+            WHERE invoice_id = (
+                SELECT invoice_id FROM payments
+                WHERE status IN ('queued', 'verifying') AND next_attempt_at <= ?
+                ORDER BY next_attempt_at LIMIT 1
+            )
+            RETURNING *
+        ''', (now_ts + PAYMENT_VERIFY_LEASE_SECONDS, now_ts, now_ts)).fetchone()
+
+def process_payment(payment):
+    db = get_db()
+    invoice_id = payment['invoice_id']
+    verify_data = {
+        'pin': AQAYEPARDARAKHT_PIN,
+        'amount': payment['amount'],
+        'transid': payment['trans_id']
+    }
+    try:
+        response = payment_gateway.verify(verify_data)
+        response.raise_for_status()
+        verify_json_data = response.json()
+    except requests.exceptions.RequestException as e: # Includes GatewayUnavailable and bad JSON
+        now_ts = int(time.time())
+        if payment['attempts'] >= PAYMENT_VERIFY_MAX_ATTEMPTS:
+            app.logger.error(f"Giving up verifying payment {invoice_id} after {payment['attempts']} attempts: {e}")
+            db.execute("UPDATE payments SET status = 'needs_support', last_error = ?, updated_at = ? WHERE invoice_id = ?",
+                       (str(e), now_ts, invoice_id))
+            db.commit()
+            return
+        next_attempt_at = now_ts + PAYMENT_VERIFY_RETRY_BASE_SECONDS * (2 ** (payment['attempts'] - 1))
+        app.logger.warning(f"Payment verification for {invoice_id} failed (attempt {payment['attempts']}), retrying: {e}")
+        db.execute("UPDATE payments SET status = 'queued', next_attempt_at = ?, last_error = ?, updated_at = ? WHERE invoice_id = ?",
+                   (next_attempt_at, str(e), now_ts, invoice_id))
+        # The money has probably moved; keep the slots held until we know
+        db.execute('UPDATE slot_holds SET expires_at = MAX(expires_at, ?) WHERE invoice_id = ?',
+                   (next_attempt_at + SLOT_HOLD_TTL_SECONDS, invoice_id))
+        db.commit()
+        return
+
+    if str(verify_json_data.get('code')) == '1': # Payment successful
+        finalize_paid_booking(payment['phone_number'], json.loads(payment['timeslots']), invoice_id, payment['trans_id'],
+                              resource_id=payment['resource_id'], device_id=payment['device_id'], user_agent=payment['user_agent'])
+    else: # Payment verification failed
+        app.logger.warning(f"Aqa-ye Pardakht verify failed: {verify_json_data}")
+        db.execute("UPDATE payments SET status = 'failed', result = ?, updated_at = ? WHERE invoice_id = ?",
+                   (json.dumps({'code': verify_json_data.get('code'), 'message': verify_json_data.get('message')}),
+                    int(time.time()), invoice_id))
+        db.commit()
+        release_slot_holds(invoice_id)
+
+def run_payment_worker(stop_event=None):
+    while stop_event is None or not stop_event.is_set():
+        try:
+            with app.app_context():
+                payment = _claim_due_payment(get_db())
+                if payment is not None:
+                    process_payment(payment)
+                    continue
+        except Exception as e:
+            app.logger.error(f"Payment worker error: {e}")
+        _payment_worker_wakeup.wait(PAYMENT_WORKER_POLL_SECONDS)
+        _payment_worker_wakeup.clear()
+
+@app.cli.command('payment-worker')
+def payment_worker_command():
+    """Run the payment verification worker in the foreground."""
+    threading.Thread(target=_device_activity_flusher_loop, name='device-activity-flusher', daemon=True).start()
+    run_payment_worker()
+
+# --- Request Instrumentation Hooks ---
+@app.before_request
+def start_request_instrumentation():
+    if METRICS_ENABLED:
+        g._request_started_at = time.perf_counter()
+    if PROFILE_DIR and request.headers.get(PROFILE_HEADER):
+        g._profiler = cProfile.Profile()
+        g._profiler.enable()
+
+@app.after_request
+def finish_request_instrumentation(response):
+    profiler = g.pop('_profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(PROFILE_DIR, exist_ok=True)
+        profiler.dump_stats(os.path.join(PROFILE_DIR, f"{request.endpoint or 'unmatched'}-{int(time.time() * 1000)}.prof"))
+    started_at = g.pop('_request_started_at', None)
+    if started_at is not None:
+        REQUEST_DURATION.observe(time.perf_counter() - started_at, request.endpoint or 'unmatched', request.method, str(response.status_code))
+    return response
+
+def _template_render_started(sender, template, context, **extra):
+    if METRICS_ENABLED:
+        g.setdefault('_template_render_started', {})[template.name] = time.perf_counter()
+
+def _template_render_finished(sender, template, context, **extra):
+    started_at = g.get('_template_render_started', {}).pop(template.name, None)
+    if started_at is not None:
+        TEMPLATE_DURATION.observe(time.perf_counter() - started_at, template.name)
+
+before_render_template.connect(_template_render_started, app)
+template_rendered.connect(_template_render_finished, app)
+
 # --- Context Processors ---
+# Constants never change after startup, so they live in the Jinja globals instead of a per-render dict
+app.jinja_env.globals.update(
+    APPOINTMENT_DURATION_MINUTES=APPOINTMENT_DURATION_MINUTES,
+    APPOINTMENT_PRICE=APPOINTMENT_PRICE # Pass price to templates if needed
+)
+
+# The layout header only needs minute precision from the server: the JS clock in layout_base.html
+# overwrites the live-time span from initial_tehran_timestamp_ms as soon as the page loads.
+_layout_clock_cache = (None, None) # (epoch minute, Shamsi header string)
+
+def get_layout_clock_display(now_ts):
+    global _layout_clock_cache
+    epoch_minute = int(now_ts // 60)
+    cached_minute, cached_display = _layout_clock_cache
+    if cached_minute != epoch_minute:
+        cached_display = gregorian_dt_to_shamsi_str_obj(datetime.fromtimestamp(now_ts, TEHRAN_TZ), SHAMSI_DISPLAY_FORMAT_CURRENT_TIME)
+        _layout_clock_cache = (epoch_minute, cached_display)
+    return cached_display
+
 @app.context_processor
 def inject_global_vars():
-    current_tehran_datetime_obj = get_current_tehran_time()
-    current_tehran_shamsi_display_for_layout = gregorian_dt_to_shamsi_str_obj(current_tehran_datetime_obj, SHAMSI_DISPLAY_FORMAT_CURRENT_TIME)
-    initial_tehran_timestamp_ms = int(current_tehran_datetime_obj.timestamp() * 1000)
-    logged_in_phone = session.get('logged_in_phone')
+    now_ts = time.time()
     return dict(
-        current_tehran_shamsi_display_for_layout=current_tehran_shamsi_display_for_layout,
-        logged_in_phone=logged_in_phone,
-        APPOINTMENT_DURATION_MINUTES=APPOINTMENT_DURATION_MINUTES,
-        initial_tehran_timestamp_ms=initial_tehran_timestamp_ms,
-        APPOINTMENT_PRICE=APPOINTMENT_PRICE # Pass price to templates if needed
+        current_tehran_shamsi_display_for_layout=get_layout_clock_display(now_ts),
+        logged_in_phone=session.get('logged_in_phone'),
+        initial_tehran_timestamp_ms=int(now_ts * 1000)
     )
 
 # --- Routes ---
 @app.route('/', methods=['GET'])
 def index():
-    available_slots = generate_time_slots()
-    return render_template('index.html', slots=available_slots)
+    resource_id = request.args.get('resource_id', DEFAULT_RESOURCE_ID, type=int)
+    resource_calendar = get_resource_calendar(resource_id)
+    if resource_calendar is None:
+        abort(404)
+    current_tehran_dt = get_current_tehran_time()
+    versioned_slots = get_versioned_slots(resource_id, get_availability_etag(resource_id, current_tehran_dt), current_tehran_dt)
+    return render_template('index.html', slots=versioned_slots['slots'], slot_options_html=versioned_slots['options_html'],
+                           resource_id=resource_id, resource_calendar=resource_calendar,
+                           slot_price=get_slot_price(resource_calendar), live_availability=LIVE_AVAILABILITY_ENABLED)
+
+@app.route('/api/slots', methods=['GET'])
+def api_slots():
+    resource_id = request.args.get('resource_id', DEFAULT_RESOURCE_ID, type=int)
+    if get_resource_calendar(resource_id) is None:
+        abort(404)
+    current_tehran_dt = get_current_tehran_time()
+    etag = get_availability_etag(resource_id, current_tehran_dt)
+    use_gzip = request.accept_encodings['gzip'] > 0
+    # Each encoding is a distinct representation, so it gets its own strong ETag
+    representation_etag = f'{etag}-gz' if use_gzip else etag
+    if request.if_none_match.contains(representation_etag):
+        response = make_response('', 304)
+    else:
+        versioned_slots = get_versioned_slots(resource_id, etag, current_tehran_dt)
+        response = make_response(versioned_slots['json_gzip'] if use_gzip else versioned_slots['json'])
+        response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        if use_gzip:
+            response.headers['Content-Encoding'] = 'gzip'
+    response.set_etag(representation_etag)
+    response.headers['Cache-Control'] = 'no-cache'
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/api/first-free', methods=['GET'])
+def api_first_free():
+    # Earliest bookable slot across the requested resources (all active resources by default)
+    calendars = get_resource_calendars()
+    resource_ids = [r for r in request.args.getlist('resource_id', type=int) if r in calendars] or list(calendars)
+    current_tehran_dt = get_current_tehran_time()
+    first_free = get_occupancy(current_tehran_dt.date()).first_free(resource_ids, get_current_slot_start(current_tehran_dt), DAYS_TO_SHOW)
+    if first_free is None:
+        return {'slot': None}
+    resource_id, slot_start = first_free
+    return {'slot': {'resource_id': resource_id, 'resource_name': calendars[resource_id].name,
+                     'value': slot_start, 'display': slot_start_to_shamsi_str(slot_start)}}
+
+@app.route('/events/availability', methods=['GET'])
+def availability_events():
+    # Streams hold no DB connection or request context, so under a gevent worker
+    # (gunicorn -k gevent) idle connections cost a greenlet rather than a thread.
+    if not LIVE_AVAILABILITY_ENABLED:
+        abort(404)
+    subscriber = availability_hub.subscribe()
+    if subscriber is None:
+        return Response('', status=503, headers={'Retry-After': '30'})
+    response = Response(availability_hub.stream(subscriber), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no' # Let nginx pass events through unbuffered
+    return response
 
 @app.route('/book', methods=['POST'])
 def book_appointment():
-    selected_timeslots_gregorian = request.form.getlist('timeslot')
+    response, pending_booking, payment_data = start_checkout()
+    if response is not None:
+        return response
+    try:
+        gateway_response = payment_gateway.create(payment_data)
+        gateway_response.raise_for_status() # Check for HTTP errors
+        return finish_checkout(pending_booking, gateway_response.json())
+    except (requests.exceptions.RequestException, json.JSONDecodeError) as e:
+        return finish_checkout(pending_booking, error=e)
+
+def get_slot_price(resource_calendar):
+    return APPOINTMENT_PRICE * resource_calendar.slot_minutes // APPOINTMENT_DURATION_MINUTES
+
+def start_checkout():
+    # Everything in /book before the gateway call: validation and the slot holds. Returns
+    # (response, None, None) when the checkout ends here, else (None, pending_booking, payment_data).
+    # The gateway create call is left to the caller so the ASGI server (asgi.py) can await it.
+    selected_slot_values = request.form.getlist('timeslot')
     phone_number = request.form.get('phone_number', '').strip()
-    response_redirect_to_index = make_response(redirect(url_for('index')))
-
-    if not selected_timeslots_gregorian:
-        flash('لطفاً حداقل یک بازه زمانی را انتخاب کنید.', 'error'); return response_redirect_to_index
+    resource_id = request.form.get('resource_id', DEFAULT_RESOURCE_ID, type=int)
+    resource_calendar = get_resource_calendar(resource_id)
+    if resource_calendar is None:
+        flash('منبع انتخاب شده برای رزرو معتبر نیست.', 'error')
+        return make_response(redirect(url_for('index'))), None, None
+    response_redirect_to_index = redirect_to_index(resource_id)
+
+    if not selected_slot_values:
+        flash('لطفاً حداقل یک بازه زمانی را انتخاب کنید.', 'error'); return response_redirect_to_index, None, None
     if not phone_number:
-        flash('وارد کردن شماره تلفن همراه الزامی است.', 'error'); return response_redirect_to_index
+        flash('وارد کردن شماره تلفن همراه الزامی است.', 'error'); return response_redirect_to_index, None, None
     if not phone_number.isdigit() or not (7 <= len(phone_number) <= 15):
-        flash('فرمت شماره تلفن همراه نامعتبر است. لطفاً ۷ تا ۱۵ رقم عددی وارد کنید.', 'error'); return response_redirect_to_index
+        flash('فرمت شماره تلفن همراه نامعتبر است. لطفاً ۷ تا ۱۵ رقم عددی وارد کنید.', 'error'); return response_redirect_to_index, None, None
+
+    selected_slot_starts = [parse_slot_start(resource_calendar, value) for value in dict.fromkeys(selected_slot_values)] # Drop duplicate selections
+    current_slot_start = get_current_slot_start(get_current_tehran_time())
+    if any(slot_start is None or slot_start <= current_slot_start for slot_start in selected_slot_starts):
+        flash('زمان انتخاب شده معتبر نیست. لطفاً صفحه را رفرش کرده و مجدد تلاش کنید.', 'error')
+        return response_redirect_to_index, None, None
+    selected_slot_starts = list(dict.fromkeys(selected_slot_starts))
+    total_amount = len(selected_slot_starts) * get_slot_price(resource_calendar)
+    invoice_id = str(uuid.uuid4())
 
-    # Check if any selected slot is already booked (by someone else before payment process starts)
-    current_db_booked_slots = get_booked_slots()
-    for timeslot_gregorian in selected_timeslots_gregorian:
-        if timeslot_gregorian in current_db_booked_slots:
-            shamsi_slot = gregorian_to_shamsi_str(timeslot_gregorian, SHAMSI_FORMAT_DATETIME_ONLY)
+    # Atomically hold the selected slots for the payment round-trip (fails if booked or held by someone else)
+    previous_booking = session.get('pending_booking')
+    taken_slots = claim_slot_holds(selected_slot_starts, phone_number, invoice_id, total_amount, resource_id,
+                                   previous_booking['invoice_id'] if previous_booking else None)
+    for slot_start in selected_slot_starts:
+        if slot_start in taken_slots:
+            shamsi_slot = slot_start_to_shamsi_str(slot_start, SHAMSI_FORMAT_DATETIME_ONLY)
             flash(f'متاسفانه زمان انتخابی {shamsi_slot} به تازگی توسط شخص دیگری رزرو شده است. لطفاً صفحه را رفرش کرده و مجدد تلاش کنید.', 'error')
-            return response_redirect_to_index
+            return response_redirect_to_index, None, None
 
-    total_amount = len(selected_timeslots_gregorian) * APPOINTMENT_PRICE
-    invoice_id = str(uuid.uuid4())
-
-    # Store booking details in session before redirecting to payment
-    session['pending_booking'] = {
-        'timeslots': selected_timeslots_gregorian,
+    pending_booking = {
+        'timeslots': selected_slot_starts,
         'phone_number': phone_number,
         'amount': total_amount,
-        'invoice_id': invoice_id
+        'invoice_id': invoice_id,
+        'resource_id': resource_id
     }
-
     payment_data = {
         'pin': "28822683C383CB9442BF",
         'amount': total_amount,
         'callback': url_for('verify_payment', _external=True),
         'mobile': phone_number, # Optional, but good for AP records
         'invoice_id': invoice_id,
-        'description': f"رزرو {len(selected_timeslots_gregorian)} نوبت از سامانه"
+        'description': f"رزرو {len(selected_slot_starts)} نوبت از سامانه"
     }
+    return None, pending_booking, payment_data
 
-    try:
-        response = requests.post(AQAYEPARDARAKHT_CREATE_URL, data=payment_data, timeout=15)
-        response.raise_for_status() # Check for HTTP errors
-        payment_json_data = response.json()
-
+def finish_checkout(pending_booking, payment_json_data=None, error=None):
+    # Turns the gateway's create answer, or the error raised while getting it, into the /book response
+    if error is None:
         # IMPORTANT: Confirm the key for the transaction ID/token from Aqa-ye Pardakht documentation.
         # Common names are 'transid', 'path', 'authority', 'tracking_code'. Assuming 'transid' based on verify script.
         if payment_json_data.get('status') == 'success' and payment_json_data.get('transid'):
+            # Store booking details in session before redirecting to payment
+            session['pending_booking'] = pending_booking
             redirect_token = payment_json_data['transid']
-            payment_redirect_url = AQAYEPARDARAKHT_STARTPAY_URL + redirect_token
-            return redirect(payment_redirect_url)
-        else:
-            error_message = payment_json_data.get('message', 'ایجاد تراکنش پرداخت با خطا مواجه شد.')
-            app.logger.error(f"Aqa-ye Pardakht create error: {payment_json_data}")
-            flash(f'خطا در اتصال به درگاه پرداخت: {error_message}', 'error')
-            session.pop('pending_booking', None) # Clear pending booking
-            return response_redirect_to_index
-
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Payment gateway request failed (create): {e}")
-        flash('خطا در ارتباط با درگاه پرداخت. لطفاً لحظاتی دیگر مجدداً تلاش کنید.', 'error')
-        session.pop('pending_booking', None)
-        return response_redirect_to_index
-    except json.JSONDecodeError:
-        app.logger.error(f"Failed to decode JSON from payment gateway (create): {response.text if 'response' in locals() else 'No response text'}")
+            return redirect(AQAYEPARDARAKHT_STARTPAY_URL + redirect_token)
+        error_message = payment_json_data.get('message', 'ایجاد تراکنش پرداخت با خطا مواجه شد.')
+        app.logger.error(f"Aqa-ye Pardakht create error: {payment_json_data}")
+        flash(f'خطا در اتصال به درگاه پرداخت: {error_message}', 'error')
+    elif isinstance(error, json.JSONDecodeError):
+        app.logger.error(f"Failed to decode JSON from payment gateway (create): {error}")
         flash('پاسخ دریافتی از درگاه پرداخت نامعتبر است.', 'error')
-        session.pop('pending_booking', None)
-        return response_redirect_to_index
+    else:
+        app.logger.error(f"Payment gateway request failed (create): {error}")
+        flash('خطا در ارتباط با درگاه پرداخت. لطفاً لحظاتی دیگر مجدداً تلاش کنید.', 'error')
+    session.pop('pending_booking', None) # Clear pending booking
+    release_slot_holds(pending_booking['invoice_id'])
+    return redirect_to_index(pending_booking['resource_id'])
+
+def redirect_to_index(resource_id):
+    index_args = {'resource_id': resource_id} if resource_id != DEFAULT_RESOURCE_ID else {}
+    return make_response(redirect(url_for('index', **index_args)))
 
 @app.route('/payment/verify', methods=['GET']) # Aqa-ye Pardakht typically uses GET for callback
 def verify_payment():
@@ -236,121 +1374,74 @@ def verify_payment():
         # session.pop('pending_booking', None) # Security: clear if invoice IDs mismatch
         return redirect(url_for('index'))
 
-    verify_data = {
-        'pin': AQAYEPARDARAKHT_PIN,
-        'amount': pending_booking['amount'],
-        'transid': ap_trans_id
-    }
-
+    # Hand verification to the background worker; the callback returns immediately
+    device_id = request.cookies.get(DEVICE_ID_COOKIE_NAME) or str(uuid.uuid4())
+    user_agent = request.headers.get('User-Agent', 'Unknown')
     try:
-        response = requests.post(AQAYEPARDARAKHT_VERIFY_URL, data=verify_data, timeout=15)
-        response.raise_for_status()
-        verify_json_data = response.json()
-
-        if str(verify_json_data.get('code')) == '1': # Payment successful
-            db = get_db()
-            successful_bookings_gregorian = []
-            failed_due_to_rebooking_shamsi = []
+        enqueue_payment_verification(pending_booking['invoice_id'], ap_trans_id, device_id, user_agent)
+    except sqlite3.Error as e:
+        app.logger.error(f"Failed to queue payment verification for {pending_booking['invoice_id']}: {e}")
+        flash('خطا در ثبت درخواست تأیید پرداخت. اگر پرداخت انجام شده، لطفاً با پشتیبانی تماس بگیرید.', 'error')
+        return redirect(url_for('index'))
 
-            phone_number = pending_booking['phone_number']
-            selected_timeslots_gregorian = pending_booking['timeslots']
-            invoice_id_for_db = pending_booking['invoice_id']
+    final_response = make_response(redirect(url_for('payment_status')))
+    if request.cookies.get(DEVICE_ID_COOKIE_NAME) != device_id: # Set cookie if it wasn't there
+        final_response.set_cookie(DEVICE_ID_COOKIE_NAME, device_id, max_age=365*24*60*60, httponly=True, samesite='Lax')
+    return final_response
 
-            # Re-check slots availability before final commit
-            current_db_booked_slots = get_booked_slots()
 
-            for timeslot_gregorian in selected_timeslots_gregorian:
-                if timeslot_gregorian in current_db_booked_slots:
-                    failed_due_to_rebooking_shamsi.append(gregorian_to_shamsi_str(timeslot_gregorian, SHAMSI_FORMAT_DATETIME_ONLY))
-                    continue
+@app.route('/payment/status', methods=['GET'])
+def payment_status():
+    pending_booking = session.get('pending_booking')
+    payment = get_payment(pending_booking['invoice_id']) if pending_booking else None
+    if payment is None:
+        return redirect(url_for('index'))
 
-                try:
-                    db.execute('INSERT INTO appointments (timeslot, phone_number, invoice_id, payment_trans_id) VALUES (?, ?, ?, ?)',
-                               (timeslot_gregorian, phone_number, invoice_id_for_db, ap_trans_id))
-                    successful_bookings_gregorian.append(timeslot_gregorian)
-                except sqlite3.IntegrityError: # Should be caught by current_db_booked_slots, but as a fallback
-                    db.rollback() # Rollback individual insert if needed, or handle commit later
-                    app.logger.error(f"Integrity error inserting {timeslot_gregorian} after payment, though it passed pre-check.")
-                    failed_due_to_rebooking_shamsi.append(f"{gregorian_to_shamsi_str(timeslot_gregorian, SHAMSI_FORMAT_DATETIME_ONLY)} (خطای پایگاه داده)")
-                except Exception as e:
-                    db.rollback()
-                    app.logger.error(f"DB error booking {timeslot_gregorian} for {phone_number} after payment: {e}")
-                    failed_due_to_rebooking_shamsi.append(f"{gregorian_to_shamsi_str(timeslot_gregorian, SHAMSI_FORMAT_DATETIME_ONLY)} (خطای سیستمی)")
-
-
-            if not successful_bookings_gregorian and selected_timeslots_gregorian:
-                db.rollback() # Ensure nothing is committed if all failed
-                flash_msg_parts = ["پرداخت موفق بود، اما متاسفانه تمام زمان‌های انتخابی شما در حین فرآیند پرداخت توسط دیگران رزرو شدند:"]
-                if failed_due_to_rebooking_shamsi:
-                     flash_msg_parts.append(f"زمان(های) پر شده: {', '.join(failed_due_to_rebooking_shamsi)}.")
-                flash(" ".join(flash_msg_parts), 'error')
-                session.pop('pending_booking', None)
-                return redirect(url_for('index'))
-
-            db.commit() # Commit all successful bookings
-            session['last_booked_slots'] = successful_bookings_gregorian
-            session['last_booked_phone'] = phone_number
-
-            # Device ID and user agent update
-            device_id = request.cookies.get(DEVICE_ID_COOKIE_NAME) or str(uuid.uuid4())
-            user_agent = request.headers.get('User-Agent', 'Unknown')
-            try:
-                db.execute('''
-                    INSERT INTO user_devices (phone_number, device_id, user_agent, last_activity_time)
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                    ON CONFLICT(phone_number) DO UPDATE SET
-                        device_id=excluded.device_id, user_agent=excluded.user_agent,
-                        last_activity_time=CURRENT_TIMESTAMP
-                ''', (phone_number, device_id, user_agent))
-                db.execute('''
-                    INSERT INTO user_devices (phone_number, device_id, user_agent, last_activity_time)
-                    VALUES (?, ?, ?, CURRENT_TIMESTAMP)
-                    ON CONFLICT(device_id) DO UPDATE SET
-                        phone_number=excluded.phone_number, user_agent=excluded.user_agent,
-                        last_activity_time=CURRENT_TIMESTAMP
-                ''', (phone_number, device_id, user_agent))
-                db.commit()
-            except Exception as e:
-                db.rollback(); app.logger.error(f"Error updating device info after payment verification: {e}")
+    if payment['status'] in ('queued', 'verifying'):
+        return render_template('payment_pending.html', refresh_seconds=PAYMENT_STATUS_REFRESH_SECONDS,
+                               invoice_id=payment['invoice_id'])
 
-            final_response = make_response(redirect(url_for('booking_confirmation')))
-            if not request.cookies.get(DEVICE_ID_COOKIE_NAME) or request.cookies.get(DEVICE_ID_COOKIE_NAME) != device_id : # Set cookie if it wasn't there or changed
-                 final_response.set_cookie(DEVICE_ID_COOKIE_NAME, device_id, max_age=365*24*60*60, httponly=True, samesite='Lax')
+    if payment['status'] == 'paid':
+        result = json.loads(payment['result'])
+        successful_slot_starts = result['won']
+        failed_due_to_rebooking_shamsi = [slot_start_to_shamsi_str(s, SHAMSI_FORMAT_DATETIME_ONLY) for s in result['lost']]
+        session.pop('pending_booking', None)
 
-            flash_msg_parts = [f"پرداخت موفق! نوبت(های) شما برای {', '.join([gregorian_to_shamsi_str(s, SHAMSI_FORMAT_DATETIME_ONLY) for s in successful_bookings_gregorian])} با موفقیت رزرو شد!"]
+        if not successful_slot_starts:
+            flash_msg_parts = ["پرداخت موفق بود، اما متاسفانه تمام زمان‌های انتخابی شما در حین فرآیند پرداخت توسط دیگران رزرو شدند:"]
             if failed_due_to_rebooking_shamsi:
-                flash_msg_parts.append(f"توجه: زمان(های) {', '.join(failed_due_to_rebooking_shamsi)} در حین پرداخت توسط دیگران رزرو شده بود و برای شما ثبت نشد.")
-            flash(" ".join(flash_msg_parts), 'success' if not failed_due_to_rebooking_shamsi else 'warning')
-
-            session.pop('pending_booking', None)
-            return final_response
-
-        else: # Payment verification failed
-            error_msg = verify_json_data.get('message', 'تراکنش توسط درگاه تایید نشد.')
-            app.logger.warning(f"Aqa-ye Pardakht verify failed: {verify_json_data}")
-            flash(f"پرداخت ناموفق یا توسط شما لغو شد: {error_msg} (کد: {verify_json_data.get('code')}). وجهی از حساب شما کسر نشده است.", 'error')
-            session.pop('pending_booking', None)
+                 flash_msg_parts.append(f"زمان(های) پر شده: {', '.join(failed_due_to_rebooking_shamsi)}.")
+            flash(" ".join(flash_msg_parts), 'error')
             return redirect(url_for('index'))
 
-    except requests.exceptions.RequestException as e:
-        app.logger.error(f"Payment verification request failed: {e}")
-        flash('خطا در ارتباط با درگاه پرداخت برای تأیید نهایی. اگر پرداخت انجام شده، لطفاً با پشتیبانی تماس بگیرید.', 'error')
-        # Do not clear pending_booking, as payment might be in an ambiguous state. Support might need invoice_id.
-        return redirect(url_for('index'))
-    except json.JSONDecodeError:
-        app.logger.error(f"Failed to decode JSON from payment verification response: {response.text if 'response' in locals() else 'No response text'}")
-        flash('پاسخ دریافتی از درگاه پرداخت برای تأیید نهایی قابل پردازش نبود. لطفاً با پشتیبانی تماس بگیرید.', 'error')
+        session['last_booked_slots'] = successful_slot_starts
+        session['last_booked_phone'] = payment['phone_number']
+        flash_msg_parts = [f"پرداخت موفق! نوبت(های) شما برای {', '.join([slot_start_to_shamsi_str(s, SHAMSI_FORMAT_DATETIME_ONLY) for s in successful_slot_starts])} با موفقیت رزرو شد!"]
+        if failed_due_to_rebooking_shamsi:
+            flash_msg_parts.append(f"توجه: زمان(های) {', '.join(failed_due_to_rebooking_shamsi)} در حین پرداخت توسط دیگران رزرو شده بود و برای شما ثبت نشد.")
+        flash(" ".join(flash_msg_parts), 'success' if not failed_due_to_rebooking_shamsi else 'warning')
+        return redirect(url_for('booking_confirmation'))
+
+    if payment['status'] == 'failed':
+        result = json.loads(payment['result'] or '{}')
+        error_msg = result.get('message') or 'تراکنش توسط درگاه تایید نشد.'
+        flash(f"پرداخت ناموفق یا توسط شما لغو شد: {error_msg} (کد: {result.get('code')}). وجهی از حساب شما کسر نشده است.", 'error')
+        session.pop('pending_booking', None)
         return redirect(url_for('index'))
 
+    # needs_support (verification kept failing) or the checkout expired before the callback arrived
+    flash(f"تأیید پرداخت شما امکان‌پذیر نبود. اگر پرداخت انجام شده، لطفاً با ذکر شناسه پرداخت {payment['invoice_id']} با پشتیبانی تماس بگیرید.", 'error')
+    return redirect(url_for('index'))
+
 
 @app.route('/confirmation')
 def booking_confirmation():
-    booked_slots_gregorian = session.pop('last_booked_slots', [])
+    booked_slot_starts = session.pop('last_booked_slots', [])
     phone_number = session.pop('last_booked_phone', None)
-    if not booked_slots_gregorian: # Or if already shown and session cleared
+    if not booked_slot_starts: # Or if already shown and session cleared
         # flash('اطلاعاتی برای تأییدیه یافت نشد یا قبلاً نمایش داده شده است.', 'info')
         return redirect(url_for('index')) # Avoid re-showing confirmation on refresh
-    booked_slots_shamsi_display = [gregorian_to_shamsi_str(s, SHAMSI_FORMAT_DATETIME_ONLY) for s in booked_slots_gregorian]
+    booked_slots_shamsi_display = [slot_start_to_shamsi_str(s, SHAMSI_FORMAT_DATETIME_ONLY) for s in booked_slot_starts]
     return render_template('booking_confirmation.html',
                            booked_slots_display_list=booked_slots_shamsi_display,
                            phone_number=phone_number)
@@ -359,7 +1450,10 @@ def booking_confirmation():
 @app.route('/my-appointments', methods=['GET', 'POST'])
 def my_appointments():
     db = get_db()
-    appointments_list = []
+    upcoming_appointments = []
+    history_appointments = []
+    history_next_cursor = None
+    history_cursor = parse_history_cursor(request.args.get('before'))
     device_info_to_display = None
     form_phone_number = ""
     current_logged_in_phone = session.get('logged_in_phone')
@@ -381,26 +1475,8 @@ def my_appointments():
                 device_id = str(uuid.uuid4())
                 newly_generated_device_id = device_id # Mark to set cookie
 
-            user_agent = request.headers.get('User-Agent', 'Unknown')
-            ip_address = request.remote_addr
-            try:
-                db.execute('''
-                    INSERT INTO user_devices (phone_number, device_id, user_agent, last_login_ip, last_activity_time)
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    ON CONFLICT(phone_number) DO UPDATE SET
-                        device_id=excluded.device_id, user_agent=excluded.user_agent,
-                        last_login_ip=excluded.last_login_ip, last_activity_time=CURRENT_TIMESTAMP
-                ''', (current_logged_in_phone, device_id, user_agent, ip_address))
-                db.execute('''
-                    INSERT INTO user_devices (phone_number, device_id, user_agent, last_login_ip, last_activity_time)
-                    VALUES (?, ?, ?, ?, CURRENT_TIMESTAMP)
-                    ON CONFLICT(device_id) DO UPDATE SET
-                        phone_number=excluded.phone_number, user_agent=excluded.user_agent,
-                        last_login_ip=excluded.last_login_ip, last_activity_time=CURRENT_TIMESTAMP
-                ''', (current_logged_in_phone, device_id, user_agent, ip_address))
-                db.commit()
-            except Exception as e:
-                db.rollback(); app.logger.error(f"Error updating device info on login: {e}")
+            device_activity.record_login(current_logged_in_phone, device_id, request.headers.get('User-Agent', 'Unknown'),
+                                         request.remote_addr)
 
             flash(f'نوبت‌های شما برای شماره {current_logged_in_phone} نمایش داده شد.', 'success')
             response = make_response(redirect(url_for('my_appointments'))) # Redirect to GET
@@ -412,35 +1488,54 @@ def my_appointments():
     if request.method == 'GET' and not current_logged_in_phone: # Auto-login attempt via cookie
         device_id_from_cookie = request.cookies.get(DEVICE_ID_COOKIE_NAME)
         if device_id_from_cookie:
-            user_device_info = db.execute('SELECT phone_number FROM user_devices WHERE device_id = ?', (device_id_from_cookie,)).fetchone()
-            if user_device_info and user_device_info['phone_number']:
-                session['logged_in_phone'] = user_device_info['phone_number']
-                current_logged_in_phone = user_device_info['phone_number']
+            # Read-only: the activity bump is buffered, and a login still waiting to be flushed is found there
+            auto_login_phone = device_activity.pending_phone(device_id_from_cookie)
+            if auto_login_phone is None:
+                user_device_info = db.execute('SELECT phone_number FROM user_devices WHERE device_id = ?', (device_id_from_cookie,)).fetchone()
+                auto_login_phone = user_device_info['phone_number'] if user_device_info else None
+            if auto_login_phone:
+                session['logged_in_phone'] = auto_login_phone
+                current_logged_in_phone = auto_login_phone
                 flash('نوبت‌های شما بر اساس اطلاعات دستگاه شما (ورود خودکار) نمایش داده شد.', 'info')
-                ip_address = request.remote_addr
-                try:
-                    db.execute('UPDATE user_devices SET last_activity_time=CURRENT_TIMESTAMP, last_login_ip=? WHERE device_id = ?',
-                               (ip_address, device_id_from_cookie))
-                    db.commit()
-                except Exception as e:
-                    db.rollback(); app.logger.error(f"Error updating activity on auto-login: {e}")
+                device_activity.record_activity(device_id_from_cookie, request.remote_addr)
             # else: No phone associated or device_id not found, user needs to login manually
 
     if current_logged_in_phone:
-        appts_from_db = db.execute('SELECT timeslot FROM appointments WHERE phone_number = ? ORDER BY timeslot ASC', (current_logged_in_phone,)).fetchall()
-        current_tehran_dt_for_status = get_current_tehran_time()
-        for appt in appts_from_db:
-            timeslot_gregorian = appt['timeslot']
-            appointments_list.append({
-                'shamsi_display': gregorian_to_shamsi_str(timeslot_gregorian, SHAMSI_FORMAT_FULL),
-                'status': get_appointment_status(timeslot_gregorian, current_tehran_dt_for_status)
-            })
-        device_data = db.execute('SELECT user_agent, last_login_ip FROM user_devices WHERE phone_number = ?', (current_logged_in_phone,)).fetchone()
-        if device_data:
+        current_slot_start = get_current_slot_start(get_current_tehran_time())
+        resource_calendars = get_resource_calendars()
+
+        def appointment_view(resource_id, slot_start):
+            resource_calendar = resource_calendars.get(resource_id)
+            duration_minutes = resource_calendar.slot_minutes if resource_calendar else APPOINTMENT_DURATION_MINUTES
+            return {
+                'shamsi_display': slot_start_to_shamsi_str(slot_start, SHAMSI_FORMAT_FULL),
+                'status': get_appointment_status(slot_start, current_slot_start, duration_minutes)
+            }
+
+        # Anything that may still be ongoing counts as upcoming; older appointments are history
+        longest_slot_minutes = max((c.slot_minutes for c in resource_calendars.values()), default=APPOINTMENT_DURATION_MINUTES)
+        split_slot_start = current_slot_start - longest_slot_minutes + 1
+        # Both queries are answered from the (phone_number, slot_start, resource_id) covering indexes
+        upcoming_appointments = [appointment_view(*row) for row in get_upcoming_appointments(current_logged_in_phone, split_slot_start)]
+        history_before = min(history_cursor or (split_slot_start, 0), (split_slot_start, 0))
+        history_rows = get_appointment_history(current_logged_in_phone, history_before, HISTORY_PAGE_SIZE + 1)
+        if len(history_rows) > HISTORY_PAGE_SIZE:
+            history_rows = history_rows[:HISTORY_PAGE_SIZE]
+            history_next_cursor = f"{history_rows[-1]['slot_start']}.{history_rows[-1]['resource_id']}"
+        history_appointments = [appointment_view(*row) for row in history_rows]
+        pending_device = device_activity.pending_device_info(current_logged_in_phone) # A login not yet flushed is the newest
+        if pending_device:
             device_info_to_display = {
-                'user_agent': device_data['user_agent'],
-                'ip_address': device_data['last_login_ip']
+                'user_agent': pending_device['user_agent'],
+                'ip_address': pending_device['ip_address']
             }
+        else:
+            device_data = db.execute('SELECT user_agent, last_login_ip FROM user_devices WHERE phone_number = ?', (current_logged_in_phone,)).fetchone()
+            if device_data:
+                device_info_to_display = {
+                    'user_agent': device_data['user_agent'],
+                    'ip_address': device_data['last_login_ip']
+                }
 
     # Ensure form_phone_number is set if POST failed validation before redirect and didn't result in login
     if request.method == 'POST' and not current_logged_in_phone and not form_phone_number:
@@ -448,7 +1543,10 @@ def my_appointments():
 
 
     return render_template('my_appointments.html',
-                           appointments=appointments_list,
+                           upcoming_appointments=upcoming_appointments,
+                           history_appointments=history_appointments,
+                           history_next_cursor=history_next_cursor,
+                           history_is_first_page=history_cursor is None,
                            logged_in_phone=current_logged_in_phone,
                            form_phone_number=form_phone_number,
                            device_info=device_info_to_display)
@@ -463,6 +1561,22 @@ def logout():
     return response
 
 
+@app.route('/metrics')
+def metrics():
+    if not METRICS_ENABLED:
+        abort(404)
+    lines = []
+    for metric in (REQUEST_DURATION, SQL_DURATION, GATEWAY_DURATION, TEMPLATE_DURATION, SQL_LOCK_ERRORS):
+        lines.extend(metric.render())
+    cache_stats = availability_cache.stats()
+    lines += ['# TYPE booking_availability_cache_hits_total counter', f"booking_availability_cache_hits_total {cache_stats['hits']}",
+              '# TYPE booking_availability_cache_misses_total counter', f"booking_availability_cache_misses_total {cache_stats['misses']}",
+              '# TYPE booking_gateway_circuit_open gauge', f"booking_gateway_circuit_open {int(payment_gateway.breaker.state == 'open')}"]
+    response = make_response('\n'.join(lines) + '\n')
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+
 if __name__ == '__main__':
     # init_db() # Uncomment to initialize DB if schema.sql is present and table doesn't exist
     app.run(debug=True, host='0.0.0.0', port=5000)
\ No newline at end of file
@@ -0,0 +1,276 @@
+# ASGI serving mode for the booking app (needs `pip install -r requirements-asgi.txt`: uvicorn, httpx):
+#   uvicorn asgi:application --workers 2 --host 0.0.0.0 --port 5000
+# Routes, templates and the session cookie are the Flask app's. Synchronous Flask work (routing, SQLite,
+# templates) runs on a bounded thread pool sized like the SQLite connection pool, and requests that would
+# otherwise hold a thread while they wait are handled on the event loop:
+#   POST /book                the gateway create call goes through httpx.AsyncClient; start_checkout and
+#                             finish_checkout, the SQLite work before and after it, run on the pool
+#   GET /events/availability  streams wait on availability_hub through subscriber.notify, not a thread each,
+#                             so the booking page's live availability is on by default here
+# Thousands of checkouts can wait on the gateway at once while only ASGI_THREADS threads touch SQLite.
+# Payment verification stays in the payment worker thread, as under the sync server.
+import asyncio
+import functools
+import io
+import json
+import os
+import queue
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from flask import g
+
+import app as booking_app
+
+flask_app = booking_app.app
+booking_app.LIVE_AVAILABILITY_ENABLED = os.environ.get('LIVE_AVAILABILITY_ENABLED', '1') == '1'
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', booking_app.SQLITE_POOL_SIZE or 8)) # One per pooled connection
+ASGI_GATEWAY_MAX_CONNECTIONS = int(os.environ.get('ASGI_GATEWAY_MAX_CONNECTIONS', 500)) # Checkouts beyond this queue in httpx
+# httpcore rescans its whole pool for every queued request, which is quadratic in the pool size, so the
+# connections are split over clients of at most this many each
+ASGI_GATEWAY_CONNECTIONS_PER_CLIENT = 25
+
+executor = ThreadPoolExecutor(max_workers=ASGI_THREADS, thread_name_prefix='asgi-flask')
+
+# --- Async Payment Gateway Client ---
+class AsyncPaymentGateway:
+    # create() for the event loop. Shares the sync client's circuit breaker, so both serving modes and the
+    # payment worker trip and recover together, and reports to the same GATEWAY_DURATION histogram.
+    def __init__(self, breaker, max_connections, connections_per_client):
+        self.breaker = breaker
+        self.client_count = max(1, -(-max_connections // connections_per_client))
+        self.connections_per_client = -(-max_connections // self.client_count)
+        self.clients = []
+        self._next_client = 0
+
+    def _client(self):
+        if not self.clients: # Opened on first use so servers without lifespan support work too
+            timeout = httpx.Timeout(booking_app.GATEWAY_READ_TIMEOUT_SECONDS, connect=booking_app.GATEWAY_CONNECT_TIMEOUT_SECONDS)
+            limits = httpx.Limits(max_connections=self.connections_per_client, max_keepalive_connections=self.connections_per_client)
+            self.clients = [httpx.AsyncClient(timeout=timeout, limits=limits) for _ in range(self.client_count)]
+        self._next_client = (self._next_client + 1) % self.client_count # Round robin; only the event loop gets here
+        return self.clients[self._next_client]
+
+    async def create(self, payment_data):
+        client = self._client()
+        if not self.breaker.allow():
+            self._observe(0.0, 'circuit_open')
+            raise booking_app.GatewayUnavailable(f"Payment gateway circuit is open; not calling {booking_app.AQAYEPARDARAKHT_CREATE_URL}")
+        t0 = time.perf_counter()
+        try:
+            response = await client.post(booking_app.AQAYEPARDARAKHT_CREATE_URL, data=payment_data)
+        except httpx.HTTPError as e:
+            self._observe(time.perf_counter() - t0, type(e).__name__)
+            self.breaker.record_failure()
+            raise
+        self._observe(time.perf_counter() - t0, str(response.status_code))
+        if response.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return response
+
+    async def close(self):
+        clients, self.clients = self.clients, []
+        for client in clients:
+            await client.aclose()
+
+    @staticmethod
+    def _observe(seconds, outcome):
+        if booking_app.METRICS_ENABLED:
+            booking_app.GATEWAY_DURATION.observe(seconds, 'create', outcome)
+
+gateway = AsyncPaymentGateway(booking_app.payment_gateway.breaker, ASGI_GATEWAY_MAX_CONNECTIONS, ASGI_GATEWAY_CONNECTIONS_PER_CLIENT)
+
+# --- ASGI <-> WSGI Helpers ---
+def wsgi_environ(scope, body):
+    server_name, server_port = scope.get('server') or ('localhost', 80)
+    environ = {
+        'REQUEST_METHOD': scope['method'],
+        'SCRIPT_NAME': scope.get('root_path', '').encode('utf-8').decode('latin-1'),
+        'PATH_INFO': scope['path'].encode('utf-8').decode('latin-1'),
+        'QUERY_STRING': scope['query_string'].decode('latin-1'),
+        'SERVER_NAME': server_name,
+        'SERVER_PORT': str(server_port),
+        'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+        'REMOTE_ADDR': scope['client'][0] if scope.get('client') else '',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': scope.get('scheme', 'http'),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.input_terminated': True, # The whole body is buffered, so chunked requests without a length work
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': True,
+        'wsgi.run_once': False,
+    }
+    for name, value in scope['headers']:
+        name = name.decode('latin-1').upper().replace('-', '_')
+        key = name if name in ('CONTENT_TYPE', 'CONTENT_LENGTH') else f'HTTP_{name}'
+        value = value.decode('latin-1')
+        if key in environ: # Repeated header; HTTP/2 sends each cookie separately
+            value = f"{environ[key]}{'; ' if key == 'HTTP_COOKIE' else ','}{value}"
+        environ[key] = value
+    return environ
+
+async def read_body(receive):
+    chunks = []
+    while True:
+        message = await receive()
+        chunks.append(message.get('body', b''))
+        if message['type'] == 'http.disconnect' or not message.get('more_body'):
+            return b''.join(chunks)
+
+async def send_response(send, status, headers, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(name.lower().encode('latin-1'), value.encode('latin-1')) for name, value in headers]})
+    await send({'type': 'http.response.body', 'body': body})
+
+def call_flask(environ):
+    # A whole request through Flask's WSGI app on a pool thread, body buffered before the thread is released.
+    # Only /events/availability streams, and it never gets here.
+    captured = {}
+
+    def start_response(status, headers, exc_info=None):
+        captured['status'], captured['headers'] = int(status.split(' ', 1)[0]), headers
+
+    body_iter = flask_app(environ, start_response)
+    try:
+        body = b''.join(body_iter)
+    finally:
+        if hasattr(body_iter, 'close'):
+            body_iter.close()
+    return captured['status'], captured['headers'], body
+
+def run_flask_step(environ, step, carried=None):
+    # One synchronous step of a request that is split around an await, under Flask's request handling:
+    # session and teardown on every step, before_request hooks on the first and after_request on the last.
+    # step() returns (response, value); with no response the value goes back to the event loop, along with
+    # the instrumentation state to carry into the next step, and the request continues there.
+    with flask_app.request_context(environ):
+        try:
+            try:
+                if carried is None:
+                    rv = flask_app.preprocess_request()
+                else:
+                    rv = None
+                    for name, value in carried.items():
+                        setattr(g, name, value)
+                if rv is None:
+                    rv, value = step()
+                    if rv is None:
+                        profiler = g.pop('_profiler', None)
+                        if profiler is not None:
+                            profiler.disable() # Profiles are per thread; later steps run on other pool threads
+                        return None, value, {name: g.pop(name) for name in ('_request_started_at',) if name in g}
+            except Exception as e:
+                rv = flask_app.handle_user_exception(e)
+            response = flask_app.finalize_request(rv)
+        except Exception as e:
+            response = flask_app.handle_exception(e)
+        return (response.status_code, response.headers.to_wsgi_list(), response.get_data()), None, None
+
+def _start_checkout_step():
+    response, pending_booking, payment_data = booking_app.start_checkout()
+    return response, (pending_booking, payment_data)
+
+def _wake(loop, event):
+    try:
+        loop.call_soon_threadsafe(event.set)
+    except RuntimeError:
+        pass # Event loop already closed during shutdown
+
+# --- Async Routes ---
+async def book(scope, receive, send):
+    loop = asyncio.get_running_loop()
+    body = await read_body(receive)
+    response, checkout, carried = await loop.run_in_executor(
+        executor, run_flask_step, wsgi_environ(scope, body), _start_checkout_step)
+    if response is None:
+        pending_booking, payment_data = checkout
+        payment_json_data = error = None
+        try:
+            gateway_response = await gateway.create(payment_data)
+            gateway_response.raise_for_status() # Check for HTTP errors
+            payment_json_data = gateway_response.json()
+        except (httpx.HTTPError, booking_app.GatewayUnavailable, json.JSONDecodeError) as e:
+            error = e
+
+        def finish_step():
+            return booking_app.finish_checkout(pending_booking, payment_json_data, error), None
+        response, _, _ = await loop.run_in_executor(executor, run_flask_step, wsgi_environ(scope, body), finish_step, carried)
+    await send_response(send, *response)
+
+async def availability_events(scope, receive, send):
+    hub = booking_app.availability_hub
+    subscriber = hub.subscribe()
+    if subscriber is None:
+        await send_response(send, 503, [('Retry-After', '30')], b'')
+        return
+    wakeup = asyncio.Event()
+    subscriber.notify = functools.partial(_wake, asyncio.get_running_loop(), wakeup)
+    disconnected = asyncio.ensure_future(_wait_for_disconnect(receive))
+    try:
+        await send({'type': 'http.response.start', 'status': 200, 'headers': [
+            (b'content-type', b'text/event-stream; charset=utf-8'), (b'cache-control', b'no-cache'),
+            (b'x-accel-buffering', b'no')]}) # Let nginx pass events through unbuffered
+        await _send_chunk(send, f"retry: {booking_app.SSE_RETRY_MS}\n\n")
+        while not subscriber.dropped and not disconnected.done():
+            wakeup.clear()
+            messages = []
+            while True:
+                try:
+                    messages.append(subscriber.queue.get_nowait())
+                except queue.Empty:
+                    break
+            if messages:
+                await _send_chunk(send, ''.join(messages))
+                continue
+            woken = asyncio.ensure_future(wakeup.wait())
+            done, _ = await asyncio.wait({woken, disconnected}, timeout=booking_app.SSE_HEARTBEAT_SECONDS,
+                                         return_when=asyncio.FIRST_COMPLETED)
+            woken.cancel()
+            if not done:
+                await _send_chunk(send, ": keep-alive\n\n")
+        if subscriber.dropped:
+            await send({'type': 'http.response.body', 'body': b''}) # Slow client; it reconnects and resyncs
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(subscriber)
+
+async def _send_chunk(send, text):
+    await send({'type': 'http.response.body', 'body': text.encode('utf-8'), 'more_body': True})
+
+async def _wait_for_disconnect(receive):
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+async def dispatch_to_flask(scope, receive, send):
+    body = await read_body(receive)
+    response = await asyncio.get_running_loop().run_in_executor(executor, call_flask, wsgi_environ(scope, body))
+    await send_response(send, *response)
+
+async def lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await gateway.close()
+            await asyncio.get_running_loop().run_in_executor(executor, booking_app.device_activity.flush)
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await lifespan(receive, send)
+    elif scope['type'] != 'http':
+        return # No websocket routes
+    elif scope['method'] == 'POST' and scope['path'] == '/book':
+        await book(scope, receive, send)
+    elif scope['method'] == 'GET' and scope['path'] == '/events/availability' and booking_app.LIVE_AVAILABILITY_ENABLED:
+        await availability_events(scope, receive, send)
+    else:
+        await dispatch_to_flask(scope, receive, send)
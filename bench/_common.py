@@ -0,0 +1,76 @@
+# Shared helpers for the scripts in bench/: DB seeding and an in-process gateway stub.
+import os
+import sqlite3
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app as booking_app  # noqa: E402
+from scheduler import to_slot_start  # noqa: E402
+
+INSERT_APPOINTMENT_SQL = 'INSERT INTO appointments (slot_start, phone_number, invoice_id, payment_trans_id) VALUES (?, ?, ?, ?)'
+
+
+def seed_db(path, historical_rows, phone_numbers=1):
+    conn = sqlite3.connect(path)
+    with open(os.path.join(os.path.dirname(booking_app.__file__), 'schema.sql')) as f:
+        conn.executescript(f.read())
+    # Historical appointments end well before today, so the bookable window stays empty
+    start = to_slot_start(datetime(2000, 1, 1, 10, 0))
+    step = booking_app.APPOINTMENT_DURATION_MINUTES
+    batch = []
+    for i in range(historical_rows):
+        phone_number = f'0912{i % phone_numbers:07d}'
+        batch.append((start + step * i, phone_number, f'bench-{i}', None))
+        if len(batch) >= 50000:
+            conn.executemany(INSERT_APPOINTMENT_SQL, batch)
+            batch.clear()
+    if batch:
+        conn.executemany(INSERT_APPOINTMENT_SQL, batch)
+    conn.commit()
+    conn.close()
+
+
+class _StubResponse:
+    def __init__(self, payload):
+        self.payload = payload
+        self.text = str(payload)
+        self.status_code = 200
+
+    def raise_for_status(self):
+        pass
+
+    def json(self):
+        return self.payload
+
+
+def stub_gateway_post(url, data=None, **kwargs):
+    # In-process replacement for payment_gateway.session.post; no sockets involved
+    if url == booking_app.AQAYEPARDARAKHT_CREATE_URL:
+        return _StubResponse({'status': 'success', 'transid': f"stub-{data['invoice_id']}"})
+    return _StubResponse({'code': '1'})
+
+
+def install_gateway_stub():
+    booking_app.payment_gateway.session.post = stub_gateway_post
+
+
+def percentile(sorted_samples, pct):
+    if not sorted_samples:
+        return 0.0
+    index = min(len(sorted_samples) - 1, max(0, int(round(pct / 100 * len(sorted_samples))) - 1))
+    return sorted_samples[index]
+
+
+def complete_checkout(client, invoice_id, timeout_seconds=30):
+    # Gateway callback, then poll the status page until the payment worker has finalized the booking
+    response = client.get(f'/payment/verify?transid=stub-{invoice_id}&invoice_id={invoice_id}')
+    if not response.headers.get('Location', '').endswith('/payment/status'):
+        return response
+    deadline = time.monotonic() + timeout_seconds
+    response = client.get('/payment/status')
+    while response.status_code == 200 and time.monotonic() < deadline:
+        time.sleep(0.01)
+        response = client.get('/payment/status')
+    return response
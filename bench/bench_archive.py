@@ -0,0 +1,84 @@
+# Archival cost and benefit: moves a large appointment history into the archive while a writer thread keeps
+# inserting bookings, and times GET /my-appointments for a long-time customer before and after.
+# Usage: python bench/bench_archive.py [--rows 500000] [--batch-size 500] [--requests 200]
+import argparse
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+from _common import booking_app, percentile, seed_db
+
+HEAVY_PHONE = '09120000000'
+
+
+def time_history_page(request_count):
+    client = booking_app.app.test_client()
+    with client.session_transaction() as sess:
+        sess['logged_in_phone'] = HEAVY_PHONE
+    client.get('/my-appointments')  # warm-up
+    samples = []
+    for _ in range(request_count):
+        t0 = time.perf_counter()
+        assert client.get('/my-appointments').status_code == 200
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return percentile(samples, 50), percentile(samples, 95)
+
+
+def booking_writer(db_path, stop, samples):
+    # Stands in for /book and the payment worker: short IMMEDIATE transactions on the hot table
+    conn = sqlite3.connect(db_path, timeout=30, isolation_level=None)
+    slot_start = booking_app.get_current_slot_start(booking_app.get_current_tehran_time()) + 10 * 24 * 60
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        conn.execute('BEGIN IMMEDIATE')
+        conn.execute('INSERT INTO appointments (slot_start, phone_number) VALUES (?, ?)', (slot_start, '09350000000'))
+        conn.execute('COMMIT')
+        samples.append((time.perf_counter() - t0) * 1000)
+        slot_start += 1
+        time.sleep(0.002)
+    conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=500000)
+    parser.add_argument('--batch-size', type=int, default=booking_app.ARCHIVE_BATCH_SIZE)
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'archive.db')
+        seed_db(db_path, args.rows, phone_numbers=1)  # Every historical row belongs to HEAVY_PHONE
+        conn = sqlite3.connect(db_path)
+        conn.execute('PRAGMA journal_mode = WAL')
+        conn.close()
+        booking_app.DATABASE = db_path
+
+        before = time_history_page(args.requests)
+        stop, write_samples = threading.Event(), []
+        writer = threading.Thread(target=booking_writer, args=(db_path, stop, write_samples))
+        writer.start()
+        t0 = time.perf_counter()
+        with booking_app.app.app_context():
+            moved = booking_app.archive_past_appointments(batch_size=args.batch_size)
+        archive_seconds = time.perf_counter() - t0
+        stop.set()
+        writer.join()
+        after = time_history_page(args.requests)
+        conn = sqlite3.connect(db_path)
+        hot_rows = conn.execute('SELECT COUNT(*) FROM appointments').fetchone()[0]
+        conn.close()
+
+    write_samples.sort()
+    print(f'archived {moved} rows in {archive_seconds:.1f}s ({moved / archive_seconds:.0f} rows/s), hot table now {hot_rows} rows')
+    print(f'concurrent booking writes: n={len(write_samples)} p50={percentile(write_samples, 50):.2f}ms '
+          f'p99={percentile(write_samples, 99):.2f}ms max={write_samples[-1]:.2f}ms')
+    print(f'/my-appointments before: p50={before[0]:.2f}ms p95={before[1]:.2f}ms')
+    print(f'/my-appointments after:  p50={after[0]:.2f}ms p95={after[1]:.2f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+# Sync vs ASGI serving with many checkouts in flight against a slow payment gateway.
+# For each mode it starts the app on a fresh seeded database, either as the threaded werkzeug server that
+# app.run uses or as `uvicorn asgi:application`, then fires --checkouts POST /book requests at once, each
+# for its own free slot, while the stub gateway takes --gateway-latency seconds per create call. It reports
+# checkouts/s, POST /book latency, errors and the peak thread count of the server's process tree.
+# The client is plain asyncio, so the sync mode runs with the app's own dependencies; the asgi mode needs
+# uvicorn and httpx (requirements-asgi.txt).
+# Usage: python bench/bench_asgi.py [--checkouts 2000] [--gateway-latency 1.0] [--workers 2] [--modes sync,asgi]
+import argparse
+import asyncio
+import multiprocessing
+import os
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from _common import percentile, seed_db
+from stub_gateway import start_stub_gateway
+from suite import seed_resources, serve
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SLOT_VALUE_RE = re.compile(r'option value="([0-9]+)"')
+
+
+def process_tree_threads(pid):
+    # Threads of pid and all of its descendants (uvicorn --workers forks one process per worker)
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            tasks = os.listdir(f'/proc/{current}/task')
+        except FileNotFoundError:
+            continue
+        total += len(tasks)
+        for task in tasks:
+            try:
+                with open(f'/proc/{current}/task/{task}/children') as f:
+                    pending.extend(int(child) for child in f.read().split())
+            except FileNotFoundError:
+                pass
+    return total
+
+
+def sample_threads(pid, stop, peak):
+    while not stop.is_set():
+        peak[0] = max(peak[0], process_tree_threads(pid))
+        time.sleep(0.05)
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_sync_server(db_path, gateway_url):
+    context = multiprocessing.get_context('spawn')
+    port_queue, stop = context.Queue(), context.Event()
+    process = context.Process(target=serve, args=(db_path, gateway_url, port_queue, stop))
+    process.start()
+    port = port_queue.get(timeout=60)
+
+    def shutdown():
+        stop.set()
+        process.join(timeout=30)
+    return process.pid, f'http://127.0.0.1:{port}', shutdown
+
+
+def start_asgi_server(db_path, gateway_url, workers):
+    port = free_port()
+    env = dict(os.environ, DATABASE=db_path, AQAYEPARDARAKHT_BASE_URL=gateway_url)
+    process = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1', '--port', str(port),
+                                '--workers', str(workers), '--backlog', '4096', '--log-level', 'warning'], cwd=ROOT, env=env)
+    base_url = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while True:
+        try:
+            urllib.request.urlopen(base_url + '/', timeout=5).close()
+            break
+        except (urllib.error.URLError, OSError):
+            if time.monotonic() > deadline or process.poll() is not None:
+                process.kill()
+                raise SystemExit('uvicorn did not start')
+            time.sleep(0.2)
+
+    def shutdown():
+        process.terminate()
+        process.wait(timeout=30)
+    return process.pid, base_url, shutdown
+
+
+async def http_request(base_url, method, path, form=None, timeout=300):
+    # One request per connection (Connection: close), read to EOF; returns (status, headers, body)
+    url = urllib.parse.urlsplit(base_url)
+    body = urllib.parse.urlencode(form or {}).encode('ascii')
+    head = f'{method} {path} HTTP/1.1\r\nHost: {url.netloc}\r\nConnection: close\r\n'
+    if form is not None:
+        head += f'Content-Type: application/x-www-form-urlencoded\r\nContent-Length: {len(body)}\r\n'
+    reader, writer = await asyncio.wait_for(asyncio.open_connection(url.hostname, url.port), timeout)
+    try:
+        writer.write(head.encode('latin-1') + b'\r\n' + body)
+        raw = await asyncio.wait_for(reader.read(), timeout)
+    finally:
+        writer.close()
+    raw_head, _, payload = raw.partition(b'\r\n\r\n')
+    status_line, *header_lines = raw_head.decode('latin-1').split('\r\n')
+    headers = {name.strip().lower(): value.strip() for name, _, value in (line.partition(':') for line in header_lines)}
+    if headers.get('transfer-encoding') == 'chunked': # uvicorn chunks bodies sent without Content-Length
+        chunks = []
+        while True:
+            size_line, _, payload = payload.partition(b'\r\n')
+            size = int(size_line.split(b';')[0], 16)
+            if not size:
+                break
+            chunks.append(payload[:size])
+            payload = payload[size + 2:]
+        payload = b''.join(chunks)
+    return int(status_line.split()[1]), headers, payload
+
+
+async def free_slots(base_url, resources):
+    slots = []
+    for resource_id in range(1, resources + 1):
+        status, headers, body = await http_request(base_url, 'GET', f'/?resource_id={resource_id}', timeout=60)
+        slots.extend((resource_id, value) for value in SLOT_VALUE_RE.findall(body.decode('utf-8')))
+    return slots
+
+
+async def checkout_burst(base_url, slots):
+    async def checkout(i, resource_id, slot_value):
+        t0 = time.perf_counter()
+        try:
+            status, headers, body = await http_request(base_url, 'POST', '/book', {
+                'timeslot': slot_value, 'phone_number': f'0937{i:07d}', 'resource_id': resource_id})
+            outcome = 'started' if '/startpay/' in headers.get('location', '') else f'status {status}'
+        except (OSError, asyncio.TimeoutError, ValueError, IndexError) as e:
+            outcome = type(e).__name__
+        return (time.perf_counter() - t0) * 1000, outcome
+
+    started_at = time.perf_counter()
+    results = await asyncio.gather(*(checkout(i, r, v) for i, (r, v) in enumerate(slots)))
+    return results, time.perf_counter() - started_at
+
+
+def run(mode, seed_path, args, gateway_url, tmp):
+    db_path = os.path.join(tmp, f'{mode}.db')
+    shutil.copy(seed_path, db_path)
+    pid, base_url, shutdown = start_sync_server(db_path, gateway_url) if mode == 'sync' else \
+        start_asgi_server(db_path, gateway_url, args.workers)
+    try:
+        slots = asyncio.run(free_slots(base_url, args.resources))[:args.checkouts]
+        if len(slots) < args.checkouts:
+            print(f'only {len(slots)} free slots; raise --resources for {args.checkouts} checkouts')
+        stop, peak = threading.Event(), [0]
+        sampler = threading.Thread(target=sample_threads, args=(pid, stop, peak), daemon=True)
+        sampler.start()
+        results, wall_seconds = asyncio.run(checkout_burst(base_url, slots))
+        stop.set()
+        sampler.join()
+    finally:
+        shutdown()
+
+    latencies = sorted(ms for ms, outcome in results)
+    outcomes = {}
+    for ms, outcome in results:
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    print(f"{mode:>5}: {len(results)} checkouts in {wall_seconds:.1f}s = {outcomes.get('started', 0) / wall_seconds:.0f} started/s, "
+          f"p50={percentile(latencies, 50):.0f}ms p95={percentile(latencies, 95):.0f}ms p99={percentile(latencies, 99):.0f}ms, "
+          f"peak server threads={peak[0]}, outcomes={outcomes}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkouts', type=int, default=2000, help='POST /book requests fired at once')
+    parser.add_argument('--gateway-latency', type=float, default=1.0, help='seconds per stub gateway create call')
+    parser.add_argument('--resources', type=int, default=40, help='bookable resources seeded, to have enough free slots')
+    parser.add_argument('--workers', type=int, default=2, help='uvicorn worker processes')
+    parser.add_argument('--modes', default='sync,asgi')
+    args = parser.parse_args()
+
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE) # Client sockets and stub gateway sockets live in this process
+    resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    stub, gateway_url = start_stub_gateway(latency_seconds=args.gateway_latency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            seed_path = os.path.join(tmp, 'seed.db')
+            seed_db(seed_path, 0)
+            seed_resources(seed_path, args.resources)
+            for mode in args.modes.split(','):
+                run(mode, seed_path, args, gateway_url, tmp)
+    finally:
+        stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Measures GET / latency against appointments tables of growing size.
+# Usage: python bench/bench_availability.py [--sizes 1000,100000,1000000] [--requests 200]
+import argparse
+import os
+import tempfile
+import time
+
+from _common import booking_app, percentile, seed_db
+
+
+def time_index(client, request_count):
+    client.get('/')  # warm-up
+    samples = []
+    for _ in range(request_count):
+        t0 = time.perf_counter()
+        response = client.get('/')
+        samples.append((time.perf_counter() - t0) * 1000)
+        assert response.status_code == 200
+    samples.sort()
+    return percentile(samples, 50), percentile(samples, 95)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000')
+    parser.add_argument('--requests', type=int, default=200)
+    args = parser.parse_args()
+
+    print(f"{'rows':>10} {'p50 ms':>10} {'p95 ms':>10}")
+    for size in [int(s) for s in args.sizes.split(',')]:
+        with tempfile.TemporaryDirectory() as tmp:
+            db_path = os.path.join(tmp, 'bench.db')
+            seed_db(db_path, size)
+            booking_app.DATABASE = db_path
+            with booking_app.app.test_client() as client:
+                p50, p95 = time_index(client, args.requests)
+            print(f"{size:>10} {p50:>10.2f} {p95:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
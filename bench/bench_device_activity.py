@@ -0,0 +1,117 @@
+# Write-lock contention from user_devices activity tracking. Runs auto-login GET /my-appointments from many
+# clients while a booking writer keeps taking short IMMEDIATE transactions, once writing device activity on the
+# request path (as before buffering) and once through the device_activity buffer, and compares the two.
+# Usage: python bench/bench_device_activity.py [--clients 8] [--devices 2000] [--duration 5] [--flush-seconds 1]
+import argparse
+import multiprocessing
+import os
+import random
+import sqlite3
+import tempfile
+import threading
+import time
+
+from _common import booking_app, percentile, seed_db
+
+
+def seed_devices(path, devices):
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO user_devices (phone_number, device_id, user_agent) VALUES (?, ?, ?)',
+                     [(f'0912{i:07d}', f'bench-device-{i}', 'bench') for i in range(devices)])
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.commit()
+    conn.close()
+
+
+def auto_login_client(client_id, devices, deadline, samples, failures):
+    rng = random.Random(client_id)
+    while time.perf_counter() < deadline:
+        client = booking_app.app.test_client()  # No session, so every request takes the cookie auto-login path
+        client.set_cookie(booking_app.DEVICE_ID_COOKIE_NAME, f'bench-device-{rng.randrange(devices)}')
+        t0 = time.perf_counter()
+        try:
+            ok = client.get('/my-appointments', environ_base={'REMOTE_ADDR': f'10.0.{client_id}.{rng.randrange(256)}'}).status_code == 200
+        except Exception:
+            ok = False
+        samples.append((time.perf_counter() - t0) * 1000)
+        if not ok:
+            failures.append(1)
+
+
+def booking_writer(db_path, slot_start, stop, results):
+    # Stands in for /book and the payment worker. It runs in its own process so that only SQLite lock waits,
+    # not the clients' share of the GIL, show up in its timings; a short busy timeout turns long waits into errors.
+    conn = sqlite3.connect(db_path, timeout=0.2, isolation_level=None)
+    samples, lock_errors = [], 0
+    while not stop.is_set():
+        t0 = time.perf_counter()
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT INTO appointments (slot_start, phone_number) VALUES (?, ?)', (slot_start, '09350000000'))
+            conn.execute('COMMIT')
+            samples.append((time.perf_counter() - t0) * 1000)
+            slot_start += 1
+        except sqlite3.OperationalError:
+            lock_errors += 1
+            if conn.in_transaction:
+                conn.execute('ROLLBACK')
+        time.sleep(0.002)
+    conn.close()
+    results.put((samples, lock_errors))
+
+
+def run(mode, args, tmp):
+    db_path = os.path.join(tmp, f'{mode}.db')
+    seed_db(db_path, 0)
+    seed_devices(db_path, args.devices)
+    booking_app.DATABASE = db_path
+    booking_app.DEVICE_ACTIVITY_FLUSH_SECONDS = args.flush_seconds
+    device_activity = booking_app.device_activity
+    device_activity.write_through = mode == 'write-through'
+    flushes_before = device_activity.flushes
+
+    deadline = time.perf_counter() + args.duration
+    request_samples, failures = [], []
+    stop, writer_results = multiprocessing.Event(), multiprocessing.Queue()
+    slot_start = booking_app.get_current_slot_start(booking_app.get_current_tehran_time()) + 10 * 24 * 60
+    writer = multiprocessing.Process(target=booking_writer, args=(db_path, slot_start, stop, writer_results))
+    clients = [threading.Thread(target=auto_login_client, args=(i, args.devices, deadline, request_samples, failures))
+               for i in range(args.clients)]
+    writer.start()
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    stop.set()
+    write_samples, lock_errors = writer_results.get()
+    writer.join()
+    device_activity.flush()
+    write_transactions = device_activity.flushes - flushes_before
+    conn = sqlite3.connect(db_path)
+    touched = conn.execute("SELECT COUNT(*) FROM user_devices WHERE last_login_ip LIKE '10.0.%'").fetchone()[0]
+    conn.close()
+
+    request_samples.sort()
+    write_samples.sort()
+    print(f'{mode}: {len(request_samples) / args.duration:.0f} auto-logins/s, '
+          f'p50={percentile(request_samples, 50):.2f}ms p99={percentile(request_samples, 99):.2f}ms, '
+          f'{len(failures)} failed, {write_transactions} device write transactions, {touched} devices updated')
+    print(f'{" " * len(mode)}  booking writes: n={len(write_samples)} p50={percentile(write_samples, 50):.2f}ms '
+          f'p99={percentile(write_samples, 99):.2f}ms, {lock_errors} lock timeouts')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--devices', type=int, default=2000)
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--flush-seconds', type=float, default=1)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for mode in ('write-through', 'buffered'):
+            run(mode, args, tmp)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,65 @@
+# Checkout latency (create + verify) against the local stub gateway, pooled client vs. a new connection per call.
+# Usage: python bench/bench_gateway.py [--checkouts 300] [--concurrency 8] [--latency 0.005]
+import argparse
+import threading
+import time
+
+import requests
+
+from _common import booking_app, percentile
+from stub_gateway import point_app_at, start_stub_gateway
+
+
+def unpooled_checkout(payment_data, verify_data):
+    requests.post(booking_app.AQAYEPARDARAKHT_CREATE_URL, data=payment_data, timeout=15).json()
+    requests.post(booking_app.AQAYEPARDARAKHT_VERIFY_URL, data=verify_data, timeout=15).json()
+
+
+def pooled_checkout(payment_data, verify_data):
+    booking_app.payment_gateway.create(payment_data).json()
+    booking_app.payment_gateway.verify(verify_data).json()
+
+
+def run(checkout, checkouts, concurrency):
+    samples, lock = [], threading.Lock()
+    per_thread = checkouts // concurrency
+
+    def worker(worker_id):
+        local = []
+        for i in range(per_thread):
+            payment_data = {'amount': booking_app.APPOINTMENT_PRICE, 'invoice_id': f'{worker_id}-{i}'}
+            verify_data = {'amount': booking_app.APPOINTMENT_PRICE, 'transid': f'stub-{worker_id}-{i}'}
+            t0 = time.perf_counter()
+            checkout(payment_data, verify_data)
+            local.append((time.perf_counter() - t0) * 1000)
+        with lock:
+            samples.extend(local)
+
+    threads = [threading.Thread(target=worker, args=(w,)) for w in range(concurrency)]
+    started = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.perf_counter() - started
+    samples.sort()
+    return len(samples) / elapsed, percentile(samples, 50), percentile(samples, 99)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--checkouts', type=int, default=400)
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--latency', type=float, default=0.0, help='stub gateway think time per call (s)')
+    args = parser.parse_args()
+
+    stub, base_url = start_stub_gateway(latency_seconds=args.latency)
+    point_app_at(booking_app, base_url)
+    for label, checkout in (('unpooled', unpooled_checkout), ('pooled', pooled_checkout)):
+        throughput, p50, p99 = run(checkout, args.checkouts, args.concurrency)
+        print(f"{label:>9}: {throughput:8.1f} checkouts/s  p50={p50:.2f}ms  p99={p99:.2f}ms")
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
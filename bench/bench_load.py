@@ -0,0 +1,84 @@
+# Mixed read/write load against the Flask routes (GET /, POST /book + GET /payment/verify, GET /my-appointments).
+# Compare the tuned connection layer with the old per-request connect:
+#   python bench/bench_load.py            # pooled, WAL
+#   python bench/bench_load.py --no-pool  # fresh connection per request, rollback journal
+import argparse
+import os
+import random
+import re
+import tempfile
+import threading
+import time
+
+from _common import booking_app, complete_checkout, install_gateway_stub, percentile, seed_db
+
+SLOT_VALUE_RE = re.compile(r'option value="([0-9]+)"')
+
+
+def worker(client_id, deadline, write_ratio, results, lock):
+    client = booking_app.app.test_client()
+    rng = random.Random(client_id)
+    phone_number = f'0935{client_id:07d}'
+    samples, errors = [], 0
+    while time.perf_counter() < deadline:
+        t0 = time.perf_counter()
+        try:
+            response = client.get('/')
+            ok = response.status_code == 200
+            if ok and rng.random() < write_ratio:
+                free_slots = SLOT_VALUE_RE.findall(response.get_data(as_text=True))
+                if free_slots:
+                    client.post('/book', data={'timeslot': rng.choice(free_slots), 'phone_number': phone_number})
+                    with client.session_transaction() as sess:
+                        invoice_id = sess.get('pending_booking', {}).get('invoice_id')
+                    if invoice_id:
+                        ok = complete_checkout(client, invoice_id).status_code < 500
+            elif ok and rng.random() < 0.2:
+                ok = client.get('/my-appointments').status_code == 200
+        except Exception:
+            ok = False
+        samples.append((time.perf_counter() - t0) * 1000)
+        errors += 0 if ok else 1
+    with lock:
+        results['samples'].extend(samples)
+        results['errors'] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--duration', type=float, default=10.0)
+    parser.add_argument('--write-ratio', type=float, default=0.1)
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--no-pool', action='store_true', help='per-request connections with default journal settings')
+    args = parser.parse_args()
+
+    if args.no_pool:
+        booking_app.SQLITE_POOL_SIZE = 0
+        booking_app.SQLITE_JOURNAL_MODE = 'DELETE'
+        booking_app.SQLITE_SYNCHRONOUS = 'FULL'
+        booking_app.SQLITE_MMAP_SIZE = 0
+        booking_app.SQLITE_CACHED_STATEMENTS = 128
+    install_gateway_stub()
+    booking_app.app.logger.disabled = True
+
+    with tempfile.TemporaryDirectory() as tmp:
+        booking_app.DATABASE = os.path.join(tmp, 'bench.db')
+        seed_db(booking_app.DATABASE, args.rows, phone_numbers=1000)
+        results, lock = {'samples': [], 'errors': 0}, threading.Lock()
+        deadline = time.perf_counter() + args.duration
+        threads = [threading.Thread(target=worker, args=(i, deadline, args.write_ratio, results, lock))
+                   for i in range(args.concurrency)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+    samples = sorted(results['samples'])
+    print(f"mode={'no-pool' if args.no_pool else 'pooled'} concurrency={args.concurrency} "
+          f"iterations={len(samples)} throughput={len(samples) / args.duration:.1f}/s "
+          f"p50={percentile(samples, 50):.2f}ms p99={percentile(samples, 99):.2f}ms errors={results['errors']}")
+
+
+if __name__ == '__main__':
+    main()
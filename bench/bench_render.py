@@ -0,0 +1,46 @@
+# Per-render cost of index.html and my_appointments.html, including context processors.
+# Usage: python bench/bench_render.py [--renders 2000]
+import argparse
+import os
+import tempfile
+import time
+
+from _common import booking_app, seed_db
+
+
+def time_render(template_name, context, renders):
+    app = booking_app.app
+    with app.test_request_context('/'):
+        app.preprocess_request()
+        booking_app.render_template(template_name, **context)  # warm the template cache
+        t0 = time.perf_counter()
+        for _ in range(renders):
+            booking_app.render_template(template_name, **context)
+        return (time.perf_counter() - t0) / renders * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--renders', type=int, default=2000)
+    args = parser.parse_args()
+    tmp = tempfile.TemporaryDirectory()
+    booking_app.DATABASE = os.path.join(tmp.name, 'bench.db')
+    seed_db(booking_app.DATABASE, 0)
+
+    slots = [{'value': 31558200 + 60 * h, 'display': f'slot {h}'} for h in range(10, 22)]
+    resource_calendar = booking_app.ResourceCalendar(booking_app.DEFAULT_RESOURCE_ID, 'default', 45, 600, 1320, (3, 4))
+    appointments = [{'shamsi_display': f'appointment {i}', 'status': 'future'} for i in range(10)]
+    cases = (
+        ('index.html', {'slots': slots, 'resource_id': booking_app.DEFAULT_RESOURCE_ID, 'resource_calendar': resource_calendar,
+                        'slot_price': booking_app.get_slot_price(resource_calendar),
+                        'slot_options_html': ''.join(f'<option value="{s["value"]}">{s["display"]}</option>' for s in slots)}),
+        ('my_appointments.html', {'upcoming_appointments': appointments[:2], 'history_appointments': appointments[2:],
+                                  'history_next_cursor': '31558200.1', 'history_is_first_page': True,
+                                  'logged_in_phone': '09120000000', 'form_phone_number': '', 'device_info': None}),
+    )
+    for template_name, context in cases:
+        print(f"{template_name:>22}: {time_render(template_name, context, args.renders):8.1f} us/render")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,68 @@
+# Times the occupancy bitmap queries against many resources, without Flask or SQLite in the loop.
+# Usage: python bench/bench_scheduler.py [--resources 10,100,500] [--fill 0.9] [--repeat 2000]
+import argparse
+import os
+import random
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from scheduler import MINUTES_PER_DAY, OccupancyMap, ResourceCalendar, to_slot_start  # noqa: E402
+
+DAYS = 7
+
+
+def make_calendars(count):
+    rng = random.Random(count)
+    calendars = {}
+    for resource_id in range(1, count + 1):
+        slot_minutes = rng.choice((15, 30, 45, 60))
+        day_start_minute = rng.choice((480, 540, 600))
+        calendars[resource_id] = ResourceCalendar(resource_id, f'r{resource_id}', slot_minutes, day_start_minute,
+                                                  day_start_minute + 12 * 60, rng.sample(range(7), 2))
+    return calendars
+
+
+def make_taken(calendars, start_day, fill):
+    rng = random.Random(len(calendars))
+    taken = []
+    for resource_id, calendar in calendars.items():
+        for day in range(start_day, start_day + DAYS):
+            for index in range(calendar.slots_per_day):
+                if rng.random() < fill:
+                    taken.append((resource_id, calendar.slot_start(day, index)))
+    return taken
+
+
+def time_call(fn, repeat):
+    t0 = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - t0) / repeat * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--resources', default='10,100,500')
+    parser.add_argument('--fill', type=float, default=0.9, help='fraction of slots already taken')
+    parser.add_argument('--repeat', type=int, default=2000)
+    args = parser.parse_args()
+
+    now = to_slot_start(datetime(2026, 1, 3, 13, 7))  # A Saturday afternoon; part of today has already passed
+    today = now // MINUTES_PER_DAY
+    print(f"{'resources':>10} {'taken':>8} {'build ms':>10} {'first_free us':>14} {'day list us':>12}")
+    for count in [int(c) for c in args.resources.split(',')]:
+        calendars = make_calendars(count)
+        taken = make_taken(calendars, today, args.fill)
+        t0 = time.perf_counter()
+        occupancy = OccupancyMap.build(calendars, taken)
+        build_ms = (time.perf_counter() - t0) * 1000
+        resource_ids = list(calendars)
+        first_free_us = time_call(lambda: occupancy.first_free(resource_ids, now, DAYS), args.repeat)
+        day_list_us = time_call(lambda: list(occupancy.free_slot_indexes(1, today + 1)), args.repeat)
+        print(f"{count:>10} {len(taken):>8} {build_ms:>10.2f} {first_free_us:>14.1f} {day_list_us:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
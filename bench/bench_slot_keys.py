@@ -0,0 +1,149 @@
+# Compares TEXT timeslot keys with integer slot starts on a multi-million-row appointments table.
+# Seeds a database in the old TEXT layout, times the phone-number listing and the availability window
+# query with the old code path, migrates it with migrate_slot_keys.py, then times the app's new code.
+# Usage: python bench/bench_slot_keys.py [--rows 2000000] [--phones 20000] [--resources 20] [--repeat 200]
+import argparse
+import os
+import sqlite3
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+from _common import booking_app, percentile
+from scheduler import OccupancyMap, to_slot_start
+import migrate_slot_keys
+
+LEGACY_SCHEMA = '''
+CREATE TABLE resources (
+    id INTEGER PRIMARY KEY, name TEXT NOT NULL, slot_minutes INTEGER NOT NULL DEFAULT 45,
+    day_start_minute INTEGER NOT NULL DEFAULT 600, day_end_minute INTEGER NOT NULL DEFAULT 1320,
+    closed_weekdays TEXT NOT NULL DEFAULT '3,4', active INTEGER NOT NULL DEFAULT 1
+);
+CREATE TABLE appointments (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, resource_id INTEGER NOT NULL DEFAULT 1, timeslot TEXT NOT NULL,
+    phone_number TEXT NOT NULL, booking_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP, invoice_id TEXT, payment_trans_id TEXT
+);
+CREATE UNIQUE INDEX idx_resource_timeslot_unique ON appointments (resource_id, timeslot);
+CREATE INDEX idx_timeslot ON appointments (timeslot);
+CREATE INDEX idx_phone_number ON appointments (phone_number);
+CREATE TABLE slot_holds (
+    resource_id INTEGER NOT NULL DEFAULT 1, timeslot TEXT NOT NULL, invoice_id TEXT NOT NULL,
+    phone_number TEXT NOT NULL, expires_at INTEGER NOT NULL, PRIMARY KEY (resource_id, timeslot)
+);
+'''
+
+
+def seed_legacy_db(path, rows, phones, resources, today):
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    conn.executemany('INSERT INTO resources (id, name) VALUES (?, ?)', [(r, f'r{r}') for r in range(1, resources + 1)])
+    insert_sql = 'INSERT INTO appointments (resource_id, timeslot, phone_number) VALUES (?, ?, ?)'
+    # History: every resource fully booked, slot after slot, ending before today
+    slots_per_resource = rows // resources
+    start = datetime.combine(today, datetime.min.time()) - timedelta(minutes=45 * (slots_per_resource + 1))
+    batch = []
+    for i in range(slots_per_resource * resources):
+        resource_id, step = i % resources + 1, i // resources
+        batch.append((resource_id, (start + timedelta(minutes=45 * step)).strftime("%Y-%m-%d %H:%M"), f'0912{i % phones:07d}'))
+        if len(batch) >= 50000:
+            conn.executemany(insert_sql, batch)
+            batch.clear()
+    # Bookable window: every other default-hours slot taken on every resource
+    for day_offset in range(booking_app.DAYS_TO_SHOW):
+        day_start = datetime.combine(today + timedelta(days=day_offset), datetime.min.time()) + timedelta(hours=10)
+        for slot in range(0, 16, 2):
+            for resource_id in range(1, resources + 1):
+                batch.append((resource_id, (day_start + timedelta(minutes=45 * slot)).strftime("%Y-%m-%d %H:%M"), 'window'))
+    conn.executemany(insert_sql, batch)
+    conn.commit()
+    conn.close()
+
+
+def time_samples(fn, repeat):
+    fn()  # warm-up
+    samples = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return percentile(samples, 50), percentile(samples, 95)
+
+
+def legacy_listing(conn, phone_number, now_naive, calendars):
+    # Pre-migration /my-appointments: TEXT keys parsed back into datetimes for every row
+    statuses = []
+    for resource_id, timeslot in conn.execute('SELECT resource_id, timeslot FROM appointments WHERE phone_number = ? ORDER BY timeslot ASC',
+                                              (phone_number,)):
+        slot_start = datetime.strptime(timeslot, "%Y-%m-%d %H:%M")
+        slot_end = slot_start + timedelta(minutes=calendars[resource_id].slot_minutes)
+        statuses.append("passed" if slot_end < now_naive else "ongoing" if slot_start <= now_naive < slot_end else "future")
+    return statuses
+
+
+def legacy_availability(conn, today, calendars):
+    # Pre-migration window query; TEXT keys are parsed to slot starts before they reach the bitmap
+    window_start = datetime.combine(today, datetime.min.time())
+    window_end = window_start + timedelta(days=booking_app.DAYS_TO_SHOW)
+    rows = conn.execute('''
+        SELECT resource_id, timeslot FROM appointments WHERE timeslot >= ? AND timeslot < ?
+        UNION
+        SELECT resource_id, timeslot FROM slot_holds WHERE timeslot >= ? AND timeslot < ? AND expires_at > ?
+    ''', (window_start.strftime("%Y-%m-%d %H:%M"), window_end.strftime("%Y-%m-%d %H:%M"),
+          window_start.strftime("%Y-%m-%d %H:%M"), window_end.strftime("%Y-%m-%d %H:%M"), int(time.time()))).fetchall()
+    return OccupancyMap.build(calendars, [(r, to_slot_start(datetime.strptime(t, "%Y-%m-%d %H:%M"))) for r, t in rows])
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=2000000)
+    parser.add_argument('--phones', type=int, default=20000)
+    parser.add_argument('--resources', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    now = booking_app.get_current_tehran_time()
+    today, now_naive = now.date(), now.replace(tzinfo=None)
+    phone_number = '09120000007'
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'slot_keys.db')
+        t0 = time.perf_counter()
+        seed_legacy_db(db_path, args.rows, args.phones, args.resources, today)
+        print(f'seeded {args.rows} rows in {time.perf_counter() - t0:.1f}s')
+
+        booking_app.DATABASE = db_path
+        with booking_app.app.app_context():
+            calendars = booking_app.get_resource_calendars()
+        conn = sqlite3.connect(db_path)
+        results = {
+            'listing TEXT': time_samples(lambda: legacy_listing(conn, phone_number, now_naive, calendars), args.repeat),
+            'availability TEXT': time_samples(lambda: legacy_availability(conn, today, calendars), args.repeat),
+        }
+        conn.close()
+
+        t0 = time.perf_counter()
+        migrate_slot_keys.migrate(db_path, batch_size=5000, pause_seconds=0, keep_legacy=False, skip_invalid=False)
+        print(f'migrated in {time.perf_counter() - t0:.1f}s')
+
+        window = booking_app.get_availability_window(today)
+        current_slot_start = to_slot_start(now_naive)
+        with booking_app.app.app_context():
+            db = booking_app.get_db()
+
+            def listing():
+                return [booking_app.get_appointment_status(slot_start, current_slot_start, calendars[resource_id].slot_minutes)
+                        for resource_id, slot_start in db.execute('SELECT resource_id, slot_start FROM appointments WHERE phone_number = ? ORDER BY slot_start ASC',
+                                                                  (phone_number,))]
+            results['listing INT'] = time_samples(listing, args.repeat)
+            results['availability INT'] = time_samples(lambda: OccupancyMap.build(calendars, booking_app.get_booked_slots(*window)), args.repeat)
+            listing_plan = db.execute("EXPLAIN QUERY PLAN SELECT resource_id, slot_start FROM appointments WHERE phone_number = ? ORDER BY slot_start",
+                                      (phone_number,)).fetchall()
+
+    print(f'listing plan: {listing_plan[-1][-1]}')
+    print(f"{'query':>20} {'p50 ms':>10} {'p95 ms':>10}")
+    for name, (p50, p95) in results.items():
+        print(f"{name:>20} {p50:>10.3f} {p95:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+# Concurrency stress: many customers race for the same few slots through /book and /payment/verify.
+# Every customer who reaches the gateway pays; the run fails if any paid slot is lost or sold twice.
+# Usage: python bench/stress_double_booking.py [--customers 64] [--slots 3]
+import argparse
+import os
+import re
+import sqlite3
+import tempfile
+import threading
+
+from _common import booking_app, complete_checkout, install_gateway_stub, seed_db
+
+SLOT_VALUE_RE = re.compile(r'option value="([0-9]+)"')
+
+
+def customer(customer_id, contested_slots, barrier, results, lock):
+    client = booking_app.app.test_client()
+    barrier.wait()
+    response = client.post('/book', data={'timeslot': contested_slots, 'phone_number': f'0936{customer_id:07d}'})
+    if not response.headers.get('Location', '').startswith(booking_app.AQAYEPARDARAKHT_STARTPAY_URL):
+        with lock:
+            results['turned_away'] += 1
+        return
+    with client.session_transaction() as sess:
+        invoice_id = sess['pending_booking']['invoice_id']
+    complete_checkout(client, invoice_id)
+    with lock:
+        results['paid'].append(invoice_id)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--customers', type=int, default=64)
+    parser.add_argument('--slots', type=int, default=3)
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    install_gateway_stub()
+    booking_app.app.logger.disabled = True
+    failures = 0
+    with tempfile.TemporaryDirectory() as tmp:
+        booking_app.DATABASE = os.path.join(tmp, 'stress.db')
+        seed_db(booking_app.DATABASE, 0)
+        all_free = SLOT_VALUE_RE.findall(booking_app.app.test_client().get('/').get_data(as_text=True))
+        for round_no in range(args.rounds):
+            contested_slots = all_free[round_no * args.slots:(round_no + 1) * args.slots]
+            results, lock = {'paid': [], 'turned_away': 0}, threading.Lock()
+            barrier = threading.Barrier(args.customers)
+            threads = [threading.Thread(target=customer, args=(i, contested_slots, barrier, results, lock))
+                       for i in range(args.customers)]
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+            conn = sqlite3.connect(booking_app.DATABASE)
+            placeholders = ','.join('?' * len(results['paid'])) or "''"
+            won = conn.execute(f'SELECT COUNT(*) FROM appointments WHERE invoice_id IN ({placeholders})', results['paid']).fetchone()[0]
+            double_sold = conn.execute('SELECT COUNT(*) FROM (SELECT slot_start FROM appointments GROUP BY resource_id, slot_start HAVING COUNT(*) > 1)').fetchone()[0]
+            conn.close()
+            paid_slots = len(results['paid']) * len(contested_slots)
+            paid_but_lost = paid_slots - won
+            failures += double_sold + paid_but_lost
+            print(f"round={round_no} customers={args.customers} paid={len(results['paid'])} turned_away={results['turned_away']} "
+                  f"paid_slots={paid_slots} won_slots={won} paid_but_lost={paid_but_lost} double_sold={double_sold}")
+    print('OK' if failures == 0 else f'FAILED ({failures} anomalies)')
+    raise SystemExit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+# Local stand-in for the Aqa-ye Pardakht create/verify endpoints, speaking HTTP/1.1 keep-alive.
+# Run standalone:  python bench/stub_gateway.py --port 8765 --latency 0.05
+# then start the app with AQAYEPARDARAKHT_BASE_URL=http://127.0.0.1:8765
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs
+
+
+class StubGatewayHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True # headers and body go out in separate writes on kept-alive sockets
+
+    def _reply(self, status, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length', 0))
+        form = {k: v[0] for k, v in parse_qs(self.rfile.read(length).decode()).items()}
+        time.sleep(self.server.latency_seconds)
+        if self.server.fail:
+            self._reply(503, {'status': 'error', 'message': 'stub gateway down'})
+        elif self.path == '/api/v2/create':
+            self._reply(200, {'status': 'success', 'transid': f"stub-{form.get('invoice_id', '')}"})
+        elif self.path == '/api/v2/verify':
+            self._reply(200, {'status': 'success', 'code': '1'})
+        else:
+            self._reply(404, {'status': 'error', 'message': 'not found'})
+
+    def do_GET(self):
+        if self.path.startswith('/startpay/'):
+            self._reply(200, {'status': 'success', 'transid': self.path.rsplit('/', 1)[-1]})
+        else:
+            self._reply(404, {'status': 'error', 'message': 'not found'})
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StubGatewayServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 4096 # listen() backlog; the default of 5 stalls thousands of simultaneous checkouts
+
+
+def start_stub_gateway(port=0, latency_seconds=0.0):
+    server = StubGatewayServer(('127.0.0.1', port), StubGatewayHandler)
+    server.latency_seconds = latency_seconds
+    server.fail = False
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_address[1]}'
+
+
+def point_app_at(booking_app, base_url):
+    booking_app.AQAYEPARDARAKHT_BASE_URL = base_url
+    booking_app.AQAYEPARDARAKHT_CREATE_URL = f'{base_url}/api/v2/create'
+    booking_app.AQAYEPARDARAKHT_VERIFY_URL = f'{base_url}/api/v2/verify'
+    booking_app.AQAYEPARDARAKHT_STARTPAY_URL = f'{base_url}/startpay/'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0)
+    args = parser.parse_args()
+    stub, url = start_stub_gateway(args.port, args.latency)
+    print(f'stub gateway listening on {url}')
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stub.shutdown()
@@ -0,0 +1,278 @@
+# Reproducible load test for the booking flow over real HTTP.
+# For every seed size and concurrency level it seeds a fresh database, starts the app in its own process
+# (threaded werkzeug server, METRICS_ENABLED=1) pointed at the stub gateway from stub_gateway.py, and runs
+# virtual users that each pick a scenario per iteration from a seeded RNG:
+#   browse    GET /?resource_id=N
+#   checkout  GET /, POST /book, GET /payment/verify (the gateway callback), then GET /payment/status until done
+#   account   POST /my-appointments (first time), then GET /my-appointments
+# It reports throughput and p50/p95/p99 per route, SQLite lock errors (scraped from /metrics) and
+# double-booked slots, and writes everything to a JSON file. --compare prints the change against an older file.
+# Usage: python bench/suite.py [--sizes 0,100000] [--concurrency 8,32] [--duration 20] [--mix browse=60,checkout=15,account=25]
+#                              [--gateway-latency 0.05] [--output results.json] [--compare old.json]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import re
+import shutil
+import sqlite3
+import subprocess
+import tempfile
+import threading
+import time
+
+import requests
+
+from _common import booking_app, percentile, seed_db
+from stub_gateway import point_app_at, start_stub_gateway
+
+SLOT_VALUE_RE = re.compile(r'option value="([0-9]+)"')
+ROUTES = ('GET /', 'POST /book', 'GET /payment/verify', 'GET /payment/status', 'POST /my-appointments', 'GET /my-appointments')
+
+
+def seed_resources(path, resources):
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT OR IGNORE INTO resources (id, name) VALUES (?, ?)', [(r, f'bench-{r}') for r in range(2, resources + 1)])
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.commit()
+    conn.close()
+
+
+def serve(db_path, gateway_url, port_queue, stop):
+    # Runs in a spawned process, so the load generator and the app never share a GIL
+    from werkzeug.serving import make_server
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    booking_app.DATABASE = db_path
+    booking_app.app.logger.disabled = True
+    point_app_at(booking_app, gateway_url)
+    server = make_server('127.0.0.1', 0, booking_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    port_queue.put(server.server_port)
+    stop.wait()
+    server.shutdown()
+    booking_app.device_activity.flush()
+
+
+class VirtualUser:
+    def __init__(self, user_id, base_url, rng, resources, samples):
+        self.session = requests.Session()
+        self.base_url = base_url
+        self.rng = rng
+        self.resources = resources
+        self.samples = samples # route -> list of (ms, ok)
+        self.phone_number = f'0935{user_id:07d}'
+        self.logged_in = False
+        self.checkouts = {'started': 0, 'confirmed': 0, 'turned_away': 0, 'unfinished': 0}
+
+    def request(self, method, route, path, **kwargs):
+        t0 = time.perf_counter()
+        try:
+            response = self.session.request(method, self.base_url + path, allow_redirects=False, timeout=60, **kwargs)
+            ok = response.status_code < 500
+        except requests.RequestException:
+            response, ok = None, False
+        self.samples[route].append(((time.perf_counter() - t0) * 1000, ok))
+        return response
+
+    def browse(self):
+        return self.request('GET', 'GET /', f'/?resource_id={self.rng.randint(1, self.resources)}')
+
+    def checkout(self):
+        resource_id = self.rng.randint(1, self.resources)
+        response = self.request('GET', 'GET /', f'/?resource_id={resource_id}')
+        free_slots = SLOT_VALUE_RE.findall(response.text) if response is not None and response.status_code == 200 else []
+        if not free_slots:
+            return
+        self.checkouts['started'] += 1
+        response = self.request('POST', 'POST /book', '/book', data={
+            'timeslot': self.rng.choice(free_slots), 'phone_number': self.phone_number, 'resource_id': resource_id})
+        location = response.headers.get('Location', '') if response is not None else ''
+        if '/startpay/stub-' not in location:
+            self.checkouts['turned_away'] += 1
+            return
+        invoice_id = location.rsplit('/startpay/stub-', 1)[1]
+        response = self.request('GET', 'GET /payment/verify', '/payment/verify', params={'transid': f'stub-{invoice_id}', 'invoice_id': invoice_id})
+        deadline = time.monotonic() + 30
+        while response is not None and time.monotonic() < deadline:
+            if response.status_code == 200:
+                time.sleep(0.05) # Still pending; the page refreshes itself, poll a little faster than a browser
+            elif not response.headers.get('Location', '').endswith('/payment/status'):
+                break
+            response = self.request('GET', 'GET /payment/status', '/payment/status')
+        location = response.headers.get('Location', '') if response is not None else ''
+        self.checkouts['confirmed' if location.endswith('/confirmation') else 'unfinished'] += 1
+
+    def account(self):
+        if not self.logged_in:
+            response = self.request('POST', 'POST /my-appointments', '/my-appointments', data={'phone_number_view': self.phone_number})
+            self.logged_in = response is not None and response.status_code == 302
+        self.request('GET', 'GET /my-appointments', '/my-appointments')
+
+
+def run_user(user_id, base_url, args, scenarios, weights, start_at, deadline, results, lock):
+    rng = random.Random(args.seed * 100003 + user_id)
+    samples = {route: [] for route in ROUTES}
+    user = VirtualUser(user_id, base_url, rng, args.resources, samples)
+    while time.perf_counter() < start_at:
+        getattr(user, rng.choices(scenarios, weights)[0])() # Warm-up, not recorded
+    for route_samples in samples.values():
+        route_samples.clear()
+    user.checkouts = dict.fromkeys(user.checkouts, 0)
+    while time.perf_counter() < deadline:
+        getattr(user, rng.choices(scenarios, weights)[0])()
+    with lock:
+        for route, route_samples in samples.items():
+            results['samples'][route].extend(route_samples)
+        for outcome, count in user.checkouts.items():
+            results['checkouts'][outcome] += count
+
+
+def summarize(route_samples, duration):
+    latencies = sorted(ms for ms, ok in route_samples)
+    return {
+        'requests': len(latencies),
+        'errors': sum(1 for ms, ok in route_samples if not ok),
+        'throughput': round(len(latencies) / duration, 2),
+        'p50_ms': round(percentile(latencies, 50), 3),
+        'p95_ms': round(percentile(latencies, 95), 3),
+        'p99_ms': round(percentile(latencies, 99), 3),
+    }
+
+
+def scrape_lock_errors(base_url):
+    text = requests.get(f'{base_url}/metrics', timeout=10).text
+    return sum(int(float(line.rsplit(' ', 1)[1])) for line in text.splitlines() if line.startswith('booking_sqlite_lock_errors_total{'))
+
+
+def count_double_bookings(db_path):
+    conn = sqlite3.connect(db_path)
+    double_booked = conn.execute('SELECT COUNT(*) FROM (SELECT 1 FROM appointments GROUP BY resource_id, slot_start HAVING COUNT(*) > 1)').fetchone()[0]
+    paid_but_lost = conn.execute("SELECT COUNT(*) FROM payments WHERE status = 'paid' AND json_array_length(result, '$.lost') > 0").fetchone()[0]
+    conn.close()
+    return double_booked, paid_but_lost
+
+
+def run_one(seed_path, rows, concurrency, args, scenarios, weights, gateway_url, tmp):
+    db_path = os.path.join(tmp, f'run-{rows}-{concurrency}.db')
+    shutil.copy(seed_path, db_path)
+    context = multiprocessing.get_context('spawn')
+    port_queue, stop = context.Queue(), context.Event()
+    server = context.Process(target=serve, args=(db_path, gateway_url, port_queue, stop))
+    server.start()
+    base_url = f'http://127.0.0.1:{port_queue.get(timeout=60)}'
+
+    results, lock = {'samples': {route: [] for route in ROUTES}, 'checkouts': dict.fromkeys(('started', 'confirmed', 'turned_away', 'unfinished'), 0)}, threading.Lock()
+    start_at = time.perf_counter() + args.warmup
+    deadline = start_at + args.duration
+    users = [threading.Thread(target=run_user, args=(i, base_url, args, scenarios, weights, start_at, deadline, results, lock))
+             for i in range(concurrency)]
+    for user in users:
+        user.start()
+    for user in users:
+        user.join()
+    lock_errors = scrape_lock_errors(base_url)
+    stop.set()
+    server.join(timeout=30)
+    double_booked, paid_but_lost = count_double_bookings(db_path)
+
+    all_samples = [sample for route_samples in results['samples'].values() for sample in route_samples]
+    return {
+        'rows': rows,
+        'concurrency': concurrency,
+        'overall': summarize(all_samples, args.duration),
+        'routes': {route: summarize(route_samples, args.duration) for route, route_samples in results['samples'].items() if route_samples},
+        'checkouts': results['checkouts'],
+        'sqlite_lock_errors': lock_errors,
+        'double_booked_slots': double_booked,
+        'paid_but_lost': paid_but_lost,
+    }
+
+
+def git_revision():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=root, capture_output=True, text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=root, capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def print_run(run):
+    overall = run['overall']
+    print(f"rows={run['rows']} concurrency={run['concurrency']}: {overall['throughput']:.1f} req/s "
+          f"p50={overall['p50_ms']:.1f}ms p95={overall['p95_ms']:.1f}ms p99={overall['p99_ms']:.1f}ms errors={overall['errors']} "
+          f"lock_errors={run['sqlite_lock_errors']} double_booked={run['double_booked_slots']} checkouts={run['checkouts']}")
+    for route, stats in run['routes'].items():
+        print(f"    {route:<24} n={stats['requests']:<6} p50={stats['p50_ms']:>8.1f}ms p95={stats['p95_ms']:>8.1f}ms "
+              f"p99={stats['p99_ms']:>8.1f}ms errors={stats['errors']}")
+
+
+def print_comparison(old, new):
+    print(f"compared with {old['meta'].get('commit')} ({old['meta'].get('started_at')}):")
+    old_runs = {(run['rows'], run['concurrency']): run for run in old['runs']}
+    for run in new['runs']:
+        before = old_runs.get((run['rows'], run['concurrency']))
+        if before is None:
+            print(f"  rows={run['rows']} concurrency={run['concurrency']}: not in the older file")
+            continue
+        changes = [f"{key} {before['overall'][key]:.1f} -> {run['overall'][key]:.1f} ({(run['overall'][key] / before['overall'][key] - 1) * 100:+.0f}%)"
+                   for key in ('throughput', 'p50_ms', 'p99_ms') if before['overall'][key]]
+        print(f"  rows={run['rows']} concurrency={run['concurrency']}: " + ', '.join(changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load-test the booking flow and save the results as JSON.')
+    parser.add_argument('--sizes', default='0,100000', help='historical appointment rows to seed, comma separated')
+    parser.add_argument('--concurrency', default='8,32', help='virtual users, comma separated')
+    parser.add_argument('--duration', type=float, default=20.0, help='measured seconds per run')
+    parser.add_argument('--warmup', type=float, default=2.0)
+    parser.add_argument('--mix', default='browse=60,checkout=15,account=25', help='scenario weights')
+    parser.add_argument('--resources', type=int, default=20, help='bookable resources, so checkouts do not run out of slots')
+    parser.add_argument('--phones', type=int, default=1000, help='distinct phone numbers in the seeded history')
+    parser.add_argument('--gateway-latency', type=float, default=0.05, help='seconds the stub gateway takes per call')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', help='JSON results file (default bench/results/<commit>-<timestamp>.json)')
+    parser.add_argument('--compare', help='earlier JSON results file to compare against')
+    args = parser.parse_args()
+
+    weights_by_scenario = {name: float(weight) for name, weight in (item.split('=') for item in args.mix.split(','))}
+    scenarios, weights = list(weights_by_scenario), list(weights_by_scenario.values())
+    os.environ['METRICS_ENABLED'] = '1' # Inherited by the spawned app processes
+    commit, dirty = git_revision()
+    report = {'meta': {
+        'commit': commit, 'dirty': dirty, 'started_at': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'python': platform.python_version(), 'sqlite': sqlite3.sqlite_version, 'platform': platform.platform(),
+        'cpus': os.cpu_count(), 'args': vars(args),
+    }, 'runs': []}
+
+    stub, gateway_url = start_stub_gateway(latency_seconds=args.gateway_latency)
+    try:
+        with tempfile.TemporaryDirectory() as tmp:
+            for rows in [int(size) for size in args.sizes.split(',')]:
+                seed_path = os.path.join(tmp, f'seed-{rows}.db')
+                seed_db(seed_path, rows, phone_numbers=args.phones)
+                seed_resources(seed_path, args.resources)
+                for concurrency in [int(level) for level in args.concurrency.split(',')]:
+                    run = run_one(seed_path, rows, concurrency, args, scenarios, weights, gateway_url, tmp)
+                    print_run(run)
+                    report['runs'].append(run)
+    finally:
+        stub.shutdown()
+
+    output = args.output or os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results',
+                                         f"{commit or 'unknown'}-{time.strftime('%Y%m%d-%H%M%S')}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f'results written to {output}')
+    if args.compare:
+        with open(args.compare) as f:
+            print_comparison(json.load(f), report)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,239 @@
+# Online migration of an existing appointments.db from TEXT timeslots to integer slot starts.
+#
+# Old layout: appointments.timeslot and slot_holds.timeslot hold "YYYY-MM-DD HH:MM" strings and the
+# payments outbox stores them as JSON strings. New layout (schema.sql): slot_start INTEGER, minutes since
+# 1970-01-01 00:00 Tehran wall-clock time, which is strftime('%s', timeslot) / 60 in SQLite.
+#
+# The running app keeps serving while this works, in the style of a shadow-table schema change:
+#   1. appointments_new is created from schema.sql with its final indexes, and triggers on appointments
+#      mirror every insert, update and delete into it.
+#   2. Existing rows are copied in small id-range batches, each batch its own short write transaction,
+#      so app writes only ever wait for one batch.
+#   3. One short IMMEDIATE transaction checks the row counts, drops the triggers, swaps the tables by
+#      renaming, and converts slot_holds and the payments outbox (both small). Restart the app on the
+#      new code right after this step; the old code cannot write to the new layout.
+#   4. The old table, now appointments_legacy, is dropped unless --keep-legacy is given or rows were left in it.
+# appointments_archive (schema.sql) is created first if missing, also on databases that already use slot_start.
+# An interrupted run can simply be started again; copying is idempotent.
+#
+# Usage: python migrate_slot_keys.py [--db appointments.db] [--batch-size 5000] [--pause 0.01] [--keep-legacy]
+import argparse
+import os
+import re
+import sqlite3
+import time
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'schema.sql')
+SHADOW_TABLE = 'appointments_new'
+LEGACY_TABLE = 'appointments_legacy'
+MIRROR_TRIGGERS = ('appointments_mirror_insert', 'appointments_mirror_update', 'appointments_mirror_delete')
+APPOINTMENT_COLUMNS = ('id', 'resource_id', 'slot_start', 'phone_number', 'booking_time', 'invoice_id', 'payment_trans_id')
+
+
+def slot_start_sql(text_expr):
+    return f"CAST(strftime('%s', {text_expr}) AS INTEGER) / 60"
+
+
+def load_reference_schema():
+    # Final CREATE statements, taken from schema.sql applied to an in-memory database
+    conn = sqlite3.connect(':memory:')
+    with open(SCHEMA_PATH) as f:
+        conn.executescript(f.read())
+    objects = conn.execute("SELECT type, name, tbl_name, sql FROM sqlite_master WHERE sql IS NOT NULL").fetchall()
+    default_resources = conn.execute('SELECT * FROM resources').fetchall()
+    conn.close()
+    return objects, default_resources
+
+
+def reference_statements(objects, table):
+    create_table = [sql for type_, name, tbl_name, sql in objects if type_ == 'table' and name == table]
+    create_indexes = [sql for type_, name, tbl_name, sql in objects if type_ == 'index' and tbl_name == table]
+    return create_table + create_indexes
+
+
+def column_names(db, table):
+    return [row[1] for row in db.execute(f'PRAGMA table_info({table})')]
+
+
+def table_exists(db, table):
+    return db.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (table,)).fetchone() is not None
+
+
+def legacy_select_list(legacy_columns, prefix=''):
+    # Legacy appointments row -> new column values; older layouts lack resource_id and the payment columns
+    def column_or(name, fallback):
+        return f'{prefix}{name}' if name in legacy_columns else fallback
+    return ', '.join((f'{prefix}id', column_or('resource_id', '1'), slot_start_sql(f'{prefix}timeslot'),
+                      f'{prefix}phone_number', column_or('booking_time', 'CURRENT_TIMESTAMP'),
+                      column_or('invoice_id', 'NULL'), column_or('payment_trans_id', 'NULL')))
+
+
+def ensure_resources(db, objects, default_resources):
+    if table_exists(db, 'resources'):
+        return
+    db.execute('BEGIN IMMEDIATE')
+    for sql in reference_statements(objects, 'resources'):
+        db.execute(sql)
+    db.executemany(f"INSERT INTO resources VALUES ({','.join('?' * len(default_resources[0]))})", default_resources)
+    db.execute('COMMIT')
+
+
+def ensure_archive_table(db, objects):
+    if table_exists(db, 'appointments_archive'):
+        return
+    db.execute('BEGIN IMMEDIATE')
+    for sql in reference_statements(objects, 'appointments_archive'):
+        db.execute(sql)
+    db.execute('COMMIT')
+    print('created appointments_archive')
+
+
+def create_shadow_table(db, objects, legacy_columns):
+    if table_exists(db, SHADOW_TABLE):
+        print(f'{SHADOW_TABLE} already exists, resuming the copy')
+        return
+    columns = ', '.join(APPOINTMENT_COLUMNS)
+    new_values = legacy_select_list(legacy_columns, 'NEW.')
+    db.execute('BEGIN IMMEDIATE')
+    for sql in reference_statements(objects, 'appointments'):
+        db.execute(re.sub(r'\bappointments\b', SHADOW_TABLE, sql, count=1) if sql.startswith('CREATE TABLE')
+                   else re.sub(r'\bON appointments\b', f'ON {SHADOW_TABLE}', sql))
+    db.execute(f'''
+        CREATE TRIGGER {MIRROR_TRIGGERS[0]} AFTER INSERT ON appointments
+        WHEN strftime('%s', NEW.timeslot) IS NOT NULL
+        BEGIN
+            INSERT OR REPLACE INTO {SHADOW_TABLE} ({columns}) VALUES ({new_values});
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER {MIRROR_TRIGGERS[1]} AFTER UPDATE ON appointments
+        BEGIN
+            DELETE FROM {SHADOW_TABLE} WHERE id = OLD.id;
+            INSERT OR REPLACE INTO {SHADOW_TABLE} ({columns}) SELECT {new_values} WHERE strftime('%s', NEW.timeslot) IS NOT NULL;
+        END
+    ''')
+    db.execute(f'''
+        CREATE TRIGGER {MIRROR_TRIGGERS[2]} AFTER DELETE ON appointments
+        BEGIN
+            DELETE FROM {SHADOW_TABLE} WHERE id = OLD.id;
+        END
+    ''')
+    db.execute('COMMIT')
+
+
+def copy_in_batches(db, legacy_columns, batch_size, pause_seconds):
+    # Rows added after max_id is read are already mirrored by the insert trigger
+    max_id = db.execute('SELECT COALESCE(MAX(id), 0) FROM appointments').fetchone()[0]
+    columns = ', '.join(APPOINTMENT_COLUMNS)
+    select_list = legacy_select_list(legacy_columns)
+    started_at = time.perf_counter()
+    copied = 0
+    for batch_start in range(0, max_id, batch_size):
+        db.execute('BEGIN IMMEDIATE')
+        cursor = db.execute(f'''
+            INSERT OR IGNORE INTO {SHADOW_TABLE} ({columns})
+            SELECT {select_list} FROM appointments
+            WHERE id > ? AND id <= ? AND strftime('%s', timeslot) IS NOT NULL
+        ''', (batch_start, batch_start + batch_size))
+        db.execute('COMMIT')
+        copied += cursor.rowcount
+        if (batch_start // batch_size) % 100 == 99:
+            print(f'copied up to id {batch_start + batch_size}/{max_id} ({copied} rows, {time.perf_counter() - started_at:.1f}s)')
+        if pause_seconds:
+            time.sleep(pause_seconds)
+    print(f'copied {copied} rows in {time.perf_counter() - started_at:.1f}s')
+
+
+def _convert_slot_holds(db, objects):
+    holds = []
+    if table_exists(db, 'slot_holds'):
+        hold_columns = column_names(db, 'slot_holds')
+        if 'slot_start' in hold_columns:
+            return
+        resource_expr = 'resource_id' if 'resource_id' in hold_columns else '1'
+        holds = db.execute(f'''
+            SELECT {resource_expr}, {slot_start_sql('timeslot')}, invoice_id, phone_number, expires_at FROM slot_holds
+            WHERE strftime('%s', timeslot) IS NOT NULL
+        ''').fetchall()
+        db.execute('DROP TABLE slot_holds')
+    for sql in reference_statements(objects, 'slot_holds'):
+        db.execute(sql)
+    db.executemany('INSERT OR IGNORE INTO slot_holds (resource_id, slot_start, invoice_id, phone_number, expires_at) VALUES (?, ?, ?, ?, ?)', holds)
+
+
+def _convert_payments(db, objects):
+    if not table_exists(db, 'payments'):
+        for sql in reference_statements(objects, 'payments'):
+            db.execute(sql)
+        return
+    if 'resource_id' not in column_names(db, 'payments'):
+        db.execute('ALTER TABLE payments ADD COLUMN resource_id INTEGER NOT NULL DEFAULT 1')
+
+    def converted_array(json_path):
+        return f"json((SELECT json_group_array({slot_start_sql('value')}) FROM json_each(payments.{json_path})))"
+    db.execute(f"UPDATE payments SET timeslots = {converted_array('timeslots')} WHERE json_type(timeslots, '$[0]') = 'text'")
+    db.execute(f'''
+        UPDATE payments SET result = json_object('won', {converted_array("result, '$.won'")}, 'lost', {converted_array("result, '$.lost'")})
+        WHERE status = 'paid' AND (json_type(result, '$.won[0]') = 'text' OR json_type(result, '$.lost[0]') = 'text')
+    ''')
+
+
+def swap_tables(db, objects, skip_invalid):
+    # Returns how many rows were left behind in the legacy table
+    db.execute('BEGIN IMMEDIATE')
+    try:
+        legacy_count = db.execute('SELECT COUNT(*) FROM appointments').fetchone()[0]
+        new_count = db.execute(f'SELECT COUNT(*) FROM {SHADOW_TABLE}').fetchone()[0]
+        if legacy_count != new_count:
+            message = f'{legacy_count - new_count} appointments have an unparseable or duplicate timeslot'
+            if not skip_invalid:
+                raise SystemExit(f'{message}; fix them or rerun with --skip-invalid')
+            print(f'{message}; they stay behind in {LEGACY_TABLE}, which is kept')
+        for trigger in MIRROR_TRIGGERS:
+            db.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        db.execute(f'ALTER TABLE appointments RENAME TO {LEGACY_TABLE}')
+        db.execute(f'ALTER TABLE {SHADOW_TABLE} RENAME TO appointments')
+        _convert_slot_holds(db, objects)
+        _convert_payments(db, objects)
+        db.execute('COMMIT')
+    except BaseException:
+        db.execute('ROLLBACK')
+        raise
+    return legacy_count - new_count
+
+
+def migrate(db_path, batch_size, pause_seconds, keep_legacy, skip_invalid):
+    db = sqlite3.connect(db_path, isolation_level=None, timeout=30) # Explicit transactions only
+    try:
+        objects, default_resources = load_reference_schema()
+        ensure_archive_table(db, objects)
+        if 'slot_start' in column_names(db, 'appointments'):
+            print('appointments already uses slot_start, nothing else to do')
+            return
+        legacy_columns = column_names(db, 'appointments')
+        ensure_resources(db, objects, default_resources)
+        create_shadow_table(db, objects, legacy_columns)
+        copy_in_batches(db, legacy_columns, batch_size, pause_seconds)
+        started_at = time.perf_counter()
+        skipped_count = swap_tables(db, objects, skip_invalid)
+        print(f'swapped tables in {(time.perf_counter() - started_at) * 1000:.0f}ms; restart the app now')
+        if not keep_legacy and not skipped_count: # Never drop rows that were not copied
+            db.execute(f'DROP TABLE {LEGACY_TABLE}')
+            print(f'dropped {LEGACY_TABLE}')
+    finally:
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Convert appointments.db to integer slot starts without stopping the app.')
+    parser.add_argument('--db', default='appointments.db')
+    parser.add_argument('--batch-size', type=int, default=5000, help='rows copied per write transaction')
+    parser.add_argument('--pause', type=float, default=0.01, help='seconds to sleep between batches')
+    parser.add_argument('--keep-legacy', action='store_true', help=f'keep the old table as {LEGACY_TABLE}')
+    parser.add_argument('--skip-invalid', action='store_true', help=f'leave rows whose timeslot cannot be parsed behind in {LEGACY_TABLE} (implies --keep-legacy)')
+    args = parser.parse_args()
+    migrate(args.db, args.batch_size, args.pause, args.keep_legacy, args.skip_invalid)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+# Multi-resource slot scheduling.
+#
+# Every resource (practitioner, room, chair) has its own working hours, slot length and days off.
+# Slots are keyed by their start as whole minutes since 1970-01-01 00:00 Tehran wall-clock time ("slot
+# starts"), the value SQLite gives for strftime('%s', 'YYYY-MM-DD HH:MM') / 60. Days are numbered the
+# same way (slot_start // MINUTES_PER_DAY), so calendar arithmetic never builds a datetime.
+#
+# Occupancy is kept as one Python int per resource-day used as a fixed-width bitmap: bit i set means
+# the i-th slot of that day is booked or held. Free slots are then a single AND-NOT against the
+# resource's full-day mask, and the earliest free slot is the lowest set bit.
+from datetime import datetime, timedelta
+
+SLOT_KEY_FORMAT = "%Y-%m-%d %H:%M" # Legacy TEXT slot keys, still accepted by slot_start_from_key
+SLOT_EPOCH = datetime(1970, 1, 1)
+SLOT_EPOCH_ORDINAL = SLOT_EPOCH.toordinal()
+SLOT_EPOCH_WEEKDAY = SLOT_EPOCH.weekday() # Thursday
+MINUTES_PER_DAY = 24 * 60
+
+
+def to_slot_start(naive_dt):
+    # Naive Tehran datetime -> slot start; seconds are truncated
+    delta = naive_dt - SLOT_EPOCH
+    return delta.days * MINUTES_PER_DAY + delta.seconds // 60
+
+
+def slot_start_datetime(slot_start):
+    return SLOT_EPOCH + timedelta(minutes=slot_start)
+
+
+def slot_start_from_key(slot_key):
+    return to_slot_start(datetime.strptime(slot_key, SLOT_KEY_FORMAT))
+
+
+def day_from_date(day_date):
+    return day_date.toordinal() - SLOT_EPOCH_ORDINAL
+
+
+def weekday_of_day(day):
+    # Python weekday numbering (Monday == 0), as stored in resources.closed_weekdays
+    return (day + SLOT_EPOCH_WEEKDAY) % 7
+
+
+class ResourceCalendar:
+    __slots__ = ('resource_id', 'name', 'slot_minutes', 'day_start_minute', 'day_end_minute',
+                 'closed_weekdays', 'slots_per_day', 'full_mask')
+
+    def __init__(self, resource_id, name, slot_minutes, day_start_minute, day_end_minute, closed_weekdays):
+        self.resource_id = resource_id
+        self.name = name
+        self.slot_minutes = slot_minutes
+        self.day_start_minute = day_start_minute
+        self.day_end_minute = day_end_minute
+        self.closed_weekdays = frozenset(closed_weekdays)
+        self.slots_per_day = max(0, (day_end_minute - day_start_minute) // slot_minutes)
+        self.full_mask = (1 << self.slots_per_day) - 1
+
+    @classmethod
+    def from_row(cls, row):
+        closed_weekdays = [int(d) for d in row['closed_weekdays'].split(',') if d.strip()]
+        return cls(row['id'], row['name'], row['slot_minutes'], row['day_start_minute'], row['day_end_minute'], closed_weekdays)
+
+    def is_open(self, day):
+        return weekday_of_day(day) not in self.closed_weekdays
+
+    def slot_start(self, day, index):
+        return day * MINUTES_PER_DAY + self.day_start_minute + index * self.slot_minutes
+
+    def slot_index(self, slot_start):
+        # Index of slot_start within its day, or None if it is not on this resource's grid
+        day, minute_of_day = divmod(slot_start, MINUTES_PER_DAY)
+        if not self.is_open(day):
+            return None
+        offset = minute_of_day - self.day_start_minute
+        if offset < 0 or offset % self.slot_minutes:
+            return None
+        index = offset // self.slot_minutes
+        return index if index < self.slots_per_day else None
+
+    def slots_starting_at_or_before(self, day, cutoff):
+        # How many of the day's slots start at or before the cutoff slot start
+        offset = cutoff - (day * MINUTES_PER_DAY + self.day_start_minute)
+        if offset < 0:
+            return 0
+        return min(self.slots_per_day, offset // self.slot_minutes + 1)
+
+
+class OccupancyMap:
+    def __init__(self, calendars):
+        self.calendars = calendars # resource_id -> ResourceCalendar
+        self._bits = {} # (resource_id, day) -> int bitmap of taken slots
+
+    @classmethod
+    def build(cls, calendars, taken_slots):
+        # taken_slots: iterable of (resource_id, slot_start) pairs
+        occupancy = cls(calendars)
+        for resource_id, slot_start in taken_slots:
+            if resource_id in calendars:
+                occupancy.mark_taken(resource_id, slot_start)
+        return occupancy
+
+    def mark_taken(self, resource_id, slot_start):
+        index = self.calendars[resource_id].slot_index(slot_start)
+        if index is not None:
+            key = (resource_id, slot_start // MINUTES_PER_DAY)
+            self._bits[key] = self._bits.get(key, 0) | (1 << index)
+
+    def mark_free(self, resource_id, slot_start):
+        index = self.calendars[resource_id].slot_index(slot_start)
+        if index is not None:
+            key = (resource_id, slot_start // MINUTES_PER_DAY)
+            self._bits[key] = self._bits.get(key, 0) & ~(1 << index)
+
+    def is_taken(self, resource_id, slot_start):
+        index = self.calendars[resource_id].slot_index(slot_start)
+        return index is not None and bool(self._bits.get((resource_id, slot_start // MINUTES_PER_DAY), 0) >> index & 1)
+
+    def free_mask(self, resource_id, day, after=None):
+        # Bitmap of bookable slots; with after, slots starting at or before that slot start are excluded
+        calendar = self.calendars[resource_id]
+        if not calendar.is_open(day):
+            return 0
+        mask = calendar.full_mask & ~self._bits.get((resource_id, day), 0)
+        if after is not None and mask:
+            mask &= ~((1 << calendar.slots_starting_at_or_before(day, after)) - 1)
+        return mask
+
+    def free_slot_indexes(self, resource_id, day, after=None):
+        mask = self.free_mask(resource_id, day, after)
+        while mask:
+            lowest = mask & -mask
+            yield lowest.bit_length() - 1
+            mask ^= lowest
+
+    def first_free(self, resource_ids, after, days):
+        # Earliest free slot across resources: per day, each resource contributes its lowest free bit
+        start_day = after // MINUTES_PER_DAY
+        for day in range(start_day, start_day + days):
+            best = None # (slot start, resource_id)
+            for resource_id in resource_ids:
+                mask = self.free_mask(resource_id, day, after)
+                if not mask:
+                    continue
+                slot_start = self.calendars[resource_id].slot_start(day, (mask & -mask).bit_length() - 1)
+                if best is None or slot_start < best[0]:
+                    best = (slot_start, resource_id)
+            if best is not None:
+                return best[1], best[0]
+        return None
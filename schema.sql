@@ -1,20 +1,56 @@
+-- Bookable resources (practitioners, rooms, chairs), each with its own hours, slot length and days off
+DROP TABLE IF EXISTS resources;
+CREATE TABLE resources (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    slot_minutes INTEGER NOT NULL DEFAULT 45,
+    day_start_minute INTEGER NOT NULL DEFAULT 600, -- Minutes after local midnight (600 = 10:00)
+    day_end_minute INTEGER NOT NULL DEFAULT 1320, -- 1320 = 22:00; the last slot must end by then
+    closed_weekdays TEXT NOT NULL DEFAULT '3,4', -- Python weekday numbers; 3,4 = Thursday, Friday
+    active INTEGER NOT NULL DEFAULT 1
+);
+
+INSERT INTO resources (id, name) VALUES (1, 'default');
+
 DROP TABLE IF EXISTS appointments;
 
 CREATE TABLE appointments (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
-    timeslot TEXT NOT NULL, -- Format: "YYYY-MM-DD HH:MM" Gregorian
+    resource_id INTEGER NOT NULL DEFAULT 1 REFERENCES resources (id),
+    slot_start INTEGER NOT NULL, -- Minutes since 1970-01-01 00:00 Tehran wall-clock time (see scheduler.py)
     phone_number TEXT NOT NULL,
     booking_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
     invoice_id TEXT, -- Custom invoice ID generated by the app for this payment attempt
     payment_trans_id TEXT -- Transaction ID from Aqa-ye Pardakht after successful payment
 );
 
--- Ensures a timeslot can only be booked once by anyone
-CREATE UNIQUE INDEX IF NOT EXISTS idx_timeslot_unique ON appointments (timeslot);
--- Index for fetching appointments by phone number
-CREATE INDEX IF NOT EXISTS idx_phone_number ON appointments (phone_number);
-CREATE INDEX IF NOT EXISTS idx_invoice_id ON appointments (invoice_id);
-CREATE INDEX IF NOT EXISTS idx_payment_trans_id ON appointments (payment_trans_id);
+-- Ensures a slot of a resource can only be booked once by anyone
+CREATE UNIQUE INDEX IF NOT EXISTS idx_appointments_resource_slot ON appointments (resource_id, slot_start);
+-- Covering index for range scans over the bookable window across all resources
+CREATE INDEX IF NOT EXISTS idx_appointments_slot ON appointments (slot_start, resource_id);
+-- Covering index for a customer's appointments in slot order
+CREATE INDEX IF NOT EXISTS idx_appointments_phone_slot ON appointments (phone_number, slot_start, resource_id);
+CREATE INDEX IF NOT EXISTS idx_appointments_invoice_id ON appointments (invoice_id);
+CREATE INDEX IF NOT EXISTS idx_appointments_payment_trans_id ON appointments (payment_trans_id);
+
+-- Cold storage: appointments that started more than ARCHIVE_HORIZON_DAYS ago, moved here in small batches
+-- by the archiver so the hot table and its indexes stay bounded. With ARCHIVE_DATABASE set, the same
+-- table is created in that attached file instead.
+DROP TABLE IF EXISTS appointments_archive;
+CREATE TABLE appointments_archive (
+    id INTEGER PRIMARY KEY, -- Same id as the row had in appointments
+    resource_id INTEGER NOT NULL,
+    slot_start INTEGER NOT NULL,
+    phone_number TEXT NOT NULL,
+    booking_time TIMESTAMP,
+    invoice_id TEXT,
+    payment_trans_id TEXT,
+    archived_at INTEGER NOT NULL -- Unix epoch seconds
+);
+
+-- Covering index for keyset pagination of a customer's history
+CREATE INDEX IF NOT EXISTS idx_appointments_archive_phone_slot ON appointments_archive (phone_number, slot_start, resource_id);
+CREATE INDEX IF NOT EXISTS idx_appointments_archive_payment_trans_id ON appointments_archive (payment_trans_id);
 
 
 -- New table for user device information
@@ -27,4 +63,42 @@ CREATE TABLE user_devices (
     last_activity_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 
-CREATE INDEX IF NOT EXISTS idx_device_id ON user_devices (device_id);
\ No newline at end of file
+CREATE INDEX IF NOT EXISTS idx_device_id ON user_devices (device_id);
+
+-- Short-lived holds on slots while the customer is at the payment gateway
+DROP TABLE IF EXISTS slot_holds;
+CREATE TABLE slot_holds (
+    resource_id INTEGER NOT NULL DEFAULT 1,
+    slot_start INTEGER NOT NULL, -- Minutes since 1970-01-01 00:00 Tehran wall-clock time
+    invoice_id TEXT NOT NULL,
+    phone_number TEXT NOT NULL,
+    expires_at INTEGER NOT NULL, -- Unix epoch seconds
+    PRIMARY KEY (resource_id, slot_start) -- One hold per resource slot
+);
+
+CREATE INDEX IF NOT EXISTS idx_slot_holds_invoice_id ON slot_holds (invoice_id);
+CREATE INDEX IF NOT EXISTS idx_slot_holds_expires_at ON slot_holds (expires_at);
+CREATE INDEX IF NOT EXISTS idx_slot_holds_slot_start ON slot_holds (slot_start);
+
+
+-- Durable outbox for checkouts: written at /book, verified and finalized by the background payment worker
+DROP TABLE IF EXISTS payments;
+CREATE TABLE payments (
+    invoice_id TEXT PRIMARY KEY,
+    phone_number TEXT NOT NULL,
+    resource_id INTEGER NOT NULL DEFAULT 1,
+    timeslots TEXT NOT NULL, -- JSON array of slot starts
+    amount INTEGER NOT NULL, -- Toman
+    trans_id TEXT, -- Set when the gateway callback arrives
+    device_id TEXT,
+    user_agent TEXT,
+    status TEXT NOT NULL DEFAULT 'created', -- created, queued, verifying, paid, failed, expired, needs_support
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt_at INTEGER, -- Unix epoch seconds
+    last_error TEXT,
+    result TEXT, -- JSON: {"won": [...], "lost": [...]} when paid, gateway code/message when failed
+    created_at INTEGER NOT NULL, -- Unix epoch seconds
+    updated_at INTEGER
+);
+
+CREATE INDEX IF NOT EXISTS idx_payments_due ON payments (status, next_attempt_at);